@@ -5,7 +5,9 @@ from config import Config
 import git
 from git import RemoteProgress
 from git.exc import GitCommandError
+from git.compat import safe_decode, defenc
 import time
+import threading
 
 class CloneProgress(RemoteProgress):
     def __init__(self):
@@ -25,38 +27,58 @@ def get_working_path():
     return Config.get("output_path")
 
 
+# Repo handles of the current process, keyed by clone directory. The handles keep persistent git processes that
+# must not be shared with forked processes, so pool initializers call reset_repo_cache.
+repo_cache = {}
+
+
+def reset_repo_cache():
+    repo_cache.clear()
+
+
+def get_clone_dir():
+    return Path(get_working_path()) / "codeMining" / "clone"
+
+
 def get_repo(repo_name):
-    output_path = get_working_path()
-    clone_dir = Path(output_path) / "codeMining" / "clone"
+    clone_dir = get_clone_dir()
+    if clone_dir in repo_cache:
+        return repo_cache[clone_dir]
+
     if not clone_dir.exists() or not clone_dir.stat().st_size > 0:
         print(f"Cloning {repo_name} into {clone_dir}")
         git_repo = git.Repo.clone_from(f"https://github.com/{repo_name}.git", clone_dir, progress=CloneProgress())
     else:
         git_repo = git.Repo(clone_dir)
 
+    repo_cache[clone_dir] = git_repo
     return git_repo
 
 
+def get_worktrees_path():
+    return Path(get_working_path()) / "codeMining" / "commits"
+
+
 def cleanup_worktrees(repo_name):
-    output_path = get_working_path()
-    worktrees_path = Path(output_path) / "codeMining" / "commits"
+    worktrees_path = get_worktrees_path()
     shutil.rmtree(str(worktrees_path), ignore_errors=True)
     repo = get_repo(repo_name)
     repo.git.worktree("prune")
 
 
 def copy_commit_code(repo_name, commit, id):
-    output_path = get_working_path()
-    base_path = Path(output_path) / "codeMining" / "commits"
-    copy_path = base_path / f"{commit}-{id}"
+    copy_path = get_worktrees_path() / f"{commit}-{id}"
     if copy_path.exists():
         return copy_path
+    return add_worktree(repo_name, copy_path, commit)
+
 
+def add_worktree(repo_name, worktree_path, commit):
     repo = get_repo(repo_name)
     attempt = 0
     while True:
         try:
-            repo.git.worktree("add", str(copy_path.absolute()), commit)
+            repo.git.worktree("add", str(worktree_path.absolute()), commit)
             break
         except GitCommandError as e:
             if attempt == 3:
@@ -65,7 +87,16 @@ def copy_commit_code(repo_name, commit, id):
             attempt += 1
             time.sleep(3)
             continue
-    return copy_path
+    return worktree_path
+
+
+def switch_worktree(worktree_path, commit):
+    # Only the files that differ between the commits are rewritten. Untracked and ignored files, such as the build
+    # outputs of the previous commit, are removed so that the worktree is the same as a fresh checkout.
+    worktree = git.Git(str(worktree_path.absolute()))
+    worktree.checkout(commit, force=True, detach=True)
+    worktree.clean("-ffdx")
+    return worktree_path
 
 
 def remove_commit_code(repo_name, code_path):
@@ -74,36 +105,89 @@ def remove_commit_code(repo_name, code_path):
     repo.git.worktree("prune")
 
 
-def get_all_commits(repo_name):
+def iter_commit_changes(repo_name, paths, rev="origin/HEAD"):
+    # Streams the non-merge commits that change any of the paths, with their raw changes, from a single `git log`
+    # process. The changes are relative to the first parent, like Commit.diff, but no Commit objects are created.
     repo = get_repo(repo_name)
-    repo.git.checkout("origin/HEAD", force=True)
-    commits = []
-    unique_shas = set()
-    for commit in repo.iter_commits():
-        if len(commit.parents) > 1:
-            continue
-        if commit.hexsha in unique_shas:
-            continue
-        unique_shas.add(commit.hexsha)
-        commits.append(commit)
-    print(f"Found {len(commits)} commits")
-    return commits
+    proc = repo.git.log(
+        rev,
+        "-z",
+        "--no-merges",
+        "--full-history",
+        "-M",
+        "--raw",
+        "--no-abbrev",
+        "--format=format:%x01%H %P",
+        "--",
+        *paths,
+        as_process=True,
+    )
+    # stderr is drained while reading stdout, so that git never blocks on a full stderr pipe
+    stderr = []
+    stderr_reader = threading.Thread(target=lambda: stderr.append(proc.proc.stderr.read()), daemon=True)
+    stderr_reader.start()
+    commit = None
+    fields = iter_null_separated(proc.stdout)
+    for field in fields:
+        if field.startswith(b"\x01"):
+            if commit is not None:
+                yield commit
+            header, _, field = field[1:].partition(b"\n")
+            sha, *parents = header.decode().split()
+            commit = {"sha": sha, "parents": parents, "changes": []}
+        if field.startswith(b":"):
+            _, _, b_blob, a_blob, status = field[1:].decode().split(" ")
+            b_path = next(fields).decode(defenc, "replace")
+            a_path = next(fields).decode(defenc, "replace") if status[0] in ["R", "C"] else b_path
+            commit["changes"].append(
+                {"change_type": status[0], "b_path": b_path, "a_path": a_path, "b_blob": b_blob, "a_blob": a_blob}
+            )
+    status = proc.proc.wait()
+    stderr_reader.join()
+    if status != 0:
+        # Otherwise a failed log would look like a history without any changes
+        raise GitCommandError(proc.args, status, b"".join(stderr))
+    if commit is not None:
+        yield commit
+
+
+def iter_null_separated(stream, chunk_size=1 << 16):
+    rest = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        fields = (rest + chunk).split(b"\0")
+        rest = fields.pop()
+        yield from fields
+    if rest:
+        yield rest
 
 
-def get_file_versions(file_diff, commit, repo_name):
-    before = get_file_version(commit.parents[0].hexsha, file_diff.b_path, repo_name)
-    after = get_file_version(commit.hexsha, file_diff.a_path, repo_name)
+def get_file_versions(change, repo_name):
+    repo = get_repo(repo_name)
+    before = read_blob(git.Blob(repo, bytes.fromhex(change["b_blob"])))
+    after = read_blob(git.Blob(repo, bytes.fromhex(change["a_blob"])))
     return before, after
 
 
 def get_file_version(commit_hex, file_path, repo_name):
     repo = get_repo(repo_name)
-    return repo.git.show(f"{commit_hex}:{file_path}")
+    return read_blob(repo.commit(commit_hex).tree / file_path)
+
 
+def read_blob(blob):
+    # Blobs are read through the object database of the repo, which keeps one persistent `git cat-file --batch`
+    # process, instead of running `git show` per file version. The content is decoded the same way as `git show` output
+    content = blob.data_stream.read()
+    if content.endswith(b"\n"):
+        content = content[:-1]
+    return safe_decode(content)
 
-def get_short_commit(commit, repo_name):
+
+def get_short_commit(commit_sha, repo_name):
     repo = get_repo(repo_name)
-    return repo.git.rev_parse(commit.hexsha, short=True)
+    return repo.git.rev_parse(commit_sha, short=True)
 
 
 def get_commit_time(commit, repo_name):
@@ -111,6 +195,31 @@ def get_commit_time(commit, repo_name):
     return repo.commit(commit).committed_date
 
 
+def get_commit_times(commits, repo_name):
+    repo = get_repo(repo_name)
+    return {commit: repo.commit(commit).committed_date for commit in set(commits)}
+
+
 def get_commit(commit_sha, repo_name):
     repo = get_repo(repo_name)
     return repo.commit(commit_sha)
+
+
+def get_commit_sha(rev, repo_name):
+    repo = get_repo(repo_name)
+    return repo.commit(rev).hexsha
+
+
+def get_descendant_commit(commits, repo_name):
+    # The commit that has all the other commits as ancestors, or None if there is no such commit
+    repo = get_repo(repo_name)
+    commits = sorted(set(commits))
+    candidate = repo.git.rev_list("--topo-order", "--max-count=1", *commits)
+    if repo.git.rev_list("--max-count=1", *commits, "--not", candidate) != "":
+        return None
+    return candidate
+
+
+def fetch_commits(repo_name):
+    repo = get_repo(repo_name)
+    repo.remotes.origin.fetch()
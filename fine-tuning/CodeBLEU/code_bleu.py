@@ -6,9 +6,26 @@ import CodeBLEU.bleu as bleu
 import CodeBLEU.weighted_ngram_match as weighted_ngram_match
 import CodeBLEU.syntax_match as syntax_match
 import CodeBLEU.dataflow_match as dataflow_match
+import multiprocessing as mp
 
+keywords_cache = {}
 
-def calc_code_bleu(refs, hyp, lang="java", params="0.25,0.25,0.25,0.25"):
+
+def get_keywords(lang):
+    if lang not in keywords_cache:
+        keywords = [x.strip() for x in open("CodeBLEU/keywords/" + lang + ".txt", "r", encoding="utf-8").readlines()]
+        keywords_cache[lang] = set(keywords)
+    return keywords_cache[lang]
+
+
+def calc_match_counts(task):
+    references, hypothesis, lang = task
+    syntax_counts = syntax_match.corpus_syntax_match_counts(references, hypothesis, lang)
+    dataflow_counts = dataflow_match.corpus_dataflow_match_counts(references, hypothesis, lang)
+    return syntax_counts, dataflow_counts
+
+
+def calc_code_bleu(refs, hyp, lang="java", params="0.25,0.25,0.25,0.25", workers=1):
     alpha, beta, gamma, theta = [float(x) for x in params.split(",")]
 
     # preprocess inputs
@@ -33,7 +50,7 @@ def calc_code_bleu(refs, hyp, lang="java", params="0.25,0.25,0.25,0.25"):
     ngram_match_score = bleu.corpus_bleu(tokenized_refs, tokenized_hyps)
 
     # calculate weighted ngram match
-    keywords = [x.strip() for x in open("CodeBLEU/keywords/" + lang + ".txt", "r", encoding="utf-8").readlines()]
+    keywords = get_keywords(lang)
 
     def make_weights(reference_tokens, key_word_list):
         return {token: 1 if token in key_word_list else 0.2 for token in reference_tokens}
@@ -45,11 +62,27 @@ def calc_code_bleu(refs, hyp, lang="java", params="0.25,0.25,0.25,0.25"):
 
     weighted_ngram_match_score = weighted_ngram_match.corpus_bleu(tokenized_refs_with_weights, tokenized_hyps)
 
+    # calculate syntax and dataflow match counts, summed over shards of the hypotheses when running in parallel
+    if workers > 1 and len(hypothesis) > 1:
+        shard_size = (len(hypothesis) + workers - 1) // workers
+        tasks = [
+            (references[i : i + shard_size], hypothesis[i : i + shard_size], lang)
+            for i in range(0, len(hypothesis), shard_size)
+        ]
+        with mp.Pool(min(workers, len(tasks))) as pool:
+            shard_counts = pool.map(calc_match_counts, tasks)
+    else:
+        shard_counts = [calc_match_counts((references, hypothesis, lang))]
+    syntax_match_count = sum([s[0][0] for s in shard_counts])
+    syntax_total_count = sum([s[0][1] for s in shard_counts])
+    dataflow_match_count = sum([s[1][0] for s in shard_counts])
+    dataflow_total_count = sum([s[1][1] for s in shard_counts])
+
     # calculate syntax match
-    syntax_match_score = syntax_match.corpus_syntax_match(references, hypothesis, lang)
+    syntax_match_score = syntax_match_count / syntax_total_count
 
     # calculate dataflow match
-    dataflow_match_score = dataflow_match.corpus_dataflow_match(references, hypothesis, lang)
+    dataflow_match_score = 0 if dataflow_total_count == 0 else dataflow_match_count / dataflow_total_count
 
     code_bleu_score = (
         alpha * ngram_match_score
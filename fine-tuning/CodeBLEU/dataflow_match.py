@@ -6,7 +6,7 @@ from CodeBLEU.parser import (remove_comments_and_docstrings,
                    tree_to_token_index,
                    index_to_code_token,
                    tree_to_variable_index)
-from tree_sitter import Language, Parser
+from CodeBLEU.tree_parser import get_parser
 import pdb
 
 dfg_function={
@@ -22,11 +22,16 @@ dfg_function={
 def calc_dataflow_match(references, candidate, lang):
     return corpus_dataflow_match([references], [candidate], lang)
 
-def corpus_dataflow_match(references, candidates, lang):   
-    LANGUAGE = Language('CodeBLEU/parser/my-languages.so', lang)
-    parser = Parser()
-    parser.set_language(LANGUAGE)
-    parser = [parser,dfg_function[lang]]
+def corpus_dataflow_match(references, candidates, lang):
+    match_count, total_count = corpus_dataflow_match_counts(references, candidates, lang)
+    if total_count == 0:
+        # print("WARNING: There is no reference data-flows extracted from the whole corpus, and the data-flow match score degenerates to 0. Please consider ignoring this score.")
+        return 0
+    score = match_count / total_count
+    return score
+
+def corpus_dataflow_match_counts(references, candidates, lang):
+    parser = [get_parser(lang),dfg_function[lang]]
     match_count = 0
     total_count = 0
 
@@ -55,11 +60,7 @@ def corpus_dataflow_match(references, candidates, lang):
                     if dataflow in normalized_cand_dfg:
                             match_count += 1
                             normalized_cand_dfg.remove(dataflow)  
-    if total_count == 0:
-        # print("WARNING: There is no reference data-flows extracted from the whole corpus, and the data-flow match score degenerates to 0. Please consider ignoring this score.")
-        return 0
-    score = match_count / total_count
-    return score
+    return match_count, total_count
 
 def get_data_flow(code, parser):
     try:
@@ -6,7 +6,7 @@ from CodeBLEU.parser import (remove_comments_and_docstrings,
                    tree_to_token_index,
                    index_to_code_token,
                    tree_to_variable_index)
-from tree_sitter import Language, Parser
+from CodeBLEU.tree_parser import get_parser
 
 dfg_function={
     'python':DFG_python,
@@ -21,10 +21,14 @@ dfg_function={
 def calc_syntax_match(references, candidate, lang):
     return corpus_syntax_match([references], [candidate], lang)
 
-def corpus_syntax_match(references, candidates, lang):   
-    JAVA_LANGUAGE = Language('CodeBLEU/parser/my-languages.so', lang)
-    parser = Parser()
-    parser.set_language(JAVA_LANGUAGE)
+def corpus_syntax_match(references, candidates, lang):
+    match_count, total_count = corpus_syntax_match_counts(references, candidates, lang)
+    score = match_count / total_count
+    return score
+
+def corpus_syntax_match_counts(references, candidates, lang):
+    parser = get_parser(lang)
+    sub_tree_ids = {}
     match_count = 0
     total_count = 0
 
@@ -45,29 +49,47 @@ def corpus_syntax_match(references, candidates, lang):
 
             reference_tree = parser.parse(bytes(reference,'utf8')).root_node
 
-            def get_all_sub_trees(root_node):
-                node_stack = []
-                sub_tree_sexp_list = []
-                depth = 1
-                node_stack.append([root_node, depth])
-                while len(node_stack) != 0:
-                    cur_node, cur_depth = node_stack.pop()
-                    sub_tree_sexp_list.append([cur_node.sexp(), cur_depth])
-                    for child_node in cur_node.children:
-                        if len(child_node.children) != 0:
-                            depth = cur_depth + 1
-                            node_stack.append([child_node, depth])
-                return sub_tree_sexp_list
-            cand_sexps = [x[0] for x in get_all_sub_trees(candidate_tree)]
-            ref_sexps = get_all_sub_trees(reference_tree)
+            cand_sub_tree_keys = set(get_sub_tree_keys(candidate_tree, sub_tree_ids))
+            ref_sub_tree_keys = get_sub_tree_keys(reference_tree, sub_tree_ids)
 
-            # print(cand_sexps)
-            # print(ref_sexps)
-            
-            for sub_tree, depth in ref_sexps:
-                if sub_tree in cand_sexps:
+            for sub_tree_key in ref_sub_tree_keys:
+                if sub_tree_key in cand_sub_tree_keys:
                      match_count += 1
-            total_count += len(ref_sexps)          
+            total_count += len(ref_sub_tree_keys)          
        
-    score = match_count / total_count
-    return score
+    return match_count, total_count
+
+def get_sub_tree_keys(root_node, sub_tree_ids):
+    # Keys of the root and all its descendants with children, computed bottom-up in a single traversal. Two subtrees
+    # get the same key iff their sexp strings are the same: sexp prints named nodes with their field names, so subtrees
+    # are interned by their type and the keys and field names of their named children. Subtrees with errors, missing
+    # nodes or anonymous nodes with children are printed with special rules, so they are interned by their sexp.
+    sub_tree_keys = []
+    cursor = root_node.walk()
+    # Each entry is [node, field name, named child keys, printed by special rules]
+    stack = [[cursor.node, None, [], False]]
+    while True:
+        if cursor.goto_first_child():
+            stack.append([cursor.node, cursor.current_field_name(), [], False])
+            continue
+
+        while True:
+            node, field_name, child_keys, is_special = stack.pop()
+            is_special = is_special or node.has_error or node.is_missing or (not node.is_named and node.child_count > 0)
+            if is_special:
+                key = sub_tree_ids.setdefault(("sexp", node.sexp()), len(sub_tree_ids))
+            else:
+                key = sub_tree_ids.setdefault((node.type, tuple(child_keys)), len(sub_tree_ids))
+            if node.child_count > 0 or len(stack) == 0:
+                sub_tree_keys.append(key)
+
+            if len(stack) == 0:
+                return sub_tree_keys
+            stack[-1][3] = stack[-1][3] or is_special
+            if node.is_named:
+                stack[-1][2].append((field_name, key))
+
+            if cursor.goto_next_sibling():
+                stack.append([cursor.node, cursor.current_field_name(), [], False])
+                break
+            cursor.goto_parent()
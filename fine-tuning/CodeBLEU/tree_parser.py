@@ -0,0 +1,13 @@
+# -*- coding:utf-8 -*-
+from tree_sitter import Language, Parser
+
+parsers = {}
+
+
+def get_parser(lang):
+    # Parsers are created once per process and language, instead of once per corpus match
+    if lang not in parsers:
+        parser = Parser()
+        parser.set_language(Language("CodeBLEU/parser/my-languages.so", lang))
+        parsers[lang] = parser
+    return parsers[lang]
@@ -1,13 +1,19 @@
 import torch
+import numpy as np
 import pandas as pd
+import pickle
+from pathlib import Path
 
 
-# Since this class is pickled, only the data-related stuff is saved in self
+# Since this class is pickled, only the data-related stuff is saved in self.
+# Token ids are saved next to the pickle as flat int32 arrays with offsets, and are memory-mapped when first accessed.
 class ATRDataset(torch.utils.data.Dataset):
     def __init__(self, ds, tokenizer, split, args, save_os_id=False):
         self.initialize_tokens(tokenizer)
-        self.data = []
+        self.split = split
         self.max_length = args.max_length
+        self.tokens = None
+        inputs, outputs = [], []
         valid_length_ind = set()
         oversized_ids = []
         for i, row in ds.iterrows():
@@ -16,23 +22,89 @@ class ATRDataset(torch.utils.data.Dataset):
             if not self.has_valid_length(input, output):
                 oversized_ids.append(row["ID"])
                 continue
-            self.data.append(self.create_item(input, output))
+            inputs.append(input[0].numpy())
+            outputs.append(output[0].numpy())
             valid_length_ind.add(i)
+        self.size = len(inputs)
 
         ds_output_dir = args.output_dir / "splits"
         ds_output_dir.mkdir(exist_ok=True, parents=True)
+        self.tokens_dir = ds_output_dir / f"{split}_tokens"
         if save_os_id:
             if len(oversized_ids) > 0:
                 pd.DataFrame({"id": oversized_ids}).to_csv(ds_output_dir / f"{split}_os_ids.csv", index=False)
         else:
             ds = ds.iloc[list(valid_length_ind)].reset_index(drop=True)
             ds.to_json(ds_output_dir / f"{split}.json", orient="records", indent=2)
+            self.save_tokens(inputs, outputs)
 
     def __len__(self):
-        return len(self.data)
+        return self.size
 
     def __getitem__(self, item):
-        return self.data[item]
+        tokens = self.get_tokens()
+        input_offsets, output_offsets = tokens["input_offsets"], tokens["output_offsets"]
+        return {
+            "input_ids": tokens["input_ids"][input_offsets[item] : input_offsets[item + 1]],
+            "output_ids": tokens["output_ids"][output_offsets[item] : output_offsets[item + 1]],
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["tokens"] = None
+        return state
+
+    @staticmethod
+    def load(path):
+        dataset = pickle.load(open(str(path), "rb"))
+        # Tokens are looked up next to the pickle, so the output directory can be moved
+        dataset.tokens_dir = Path(path).parent / f"{dataset.split}_tokens"
+        return dataset
+
+    def save(self, path):
+        pickle.dump(self, open(str(path), "wb"))
+
+    def save_tokens(self, inputs, outputs):
+        self.tokens_dir.mkdir(exist_ok=True, parents=True)
+        for name, seqs in [("input", inputs), ("output", outputs)]:
+            offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(s) for s in seqs])
+            ids = np.concatenate(seqs).astype(np.int32) if len(seqs) > 0 else np.zeros(0, dtype=np.int32)
+            np.save(self.tokens_dir / f"{name}_ids.npy", ids)
+            np.save(self.tokens_dir / f"{name}_offsets.npy", offsets)
+
+    def get_tokens(self):
+        if self.tokens is None:
+            self.tokens = {
+                f"{name}_{t}": np.load(self.tokens_dir / f"{name}_{t}.npy", mmap_mode="r")
+                for name in ["input", "output"]
+                for t in ["ids", "offsets"]
+            }
+        return self.tokens
+
+    def get_lengths(self):
+        tokens = self.get_tokens()
+        input_lengths = np.diff(tokens["input_offsets"])
+        output_lengths = np.diff(tokens["output_offsets"])
+        return self.get_item_lengths(input_lengths, output_lengths).tolist()
+
+    def collate(self, batch):
+        max_input_len = max([len(b["input_ids"]) for b in batch])
+        max_labels_len = max([self.get_labels_start(b) + len(b["output_ids"]) for b in batch])
+        batch_data = {
+            "input_ids": torch.full((len(batch), max_input_len), self.pad_id, dtype=torch.long),
+            "labels": torch.full((len(batch), max_labels_len), -100, dtype=torch.long),
+            "attention_mask": torch.zeros((len(batch), max_input_len), dtype=torch.long),
+        }
+        for i, b in enumerate(batch):
+            input_len, output_len = len(b["input_ids"]), len(b["output_ids"])
+            labels_start = self.get_labels_start(b)
+            batch_data["input_ids"][i, :input_len] = torch.from_numpy(b["input_ids"].astype(np.int64))
+            batch_data["attention_mask"][i, :input_len] = 1
+            batch_data["labels"][i, labels_start : labels_start + output_len] = torch.from_numpy(
+                b["output_ids"].astype(np.int64)
+            )
+        return batch_data
 
     def initialize_tokens(self, tokenizer):
         pass
@@ -43,10 +115,22 @@ class ATRDataset(torch.utils.data.Dataset):
     def get_inference_input(self, row, tokenizer):
         return self.get_input(row, tokenizer)
 
+    def pad_inference_inputs(self, inputs):
+        max_input_len = max([i.size(1) for i in inputs])
+        input_ids = torch.full((len(inputs), max_input_len), self.pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(inputs), max_input_len), dtype=torch.long)
+        for i, input in enumerate(inputs):
+            input_ids[i, : input.size(1)] = input[0]
+            attention_mask[i, : input.size(1)] = 1
+        return input_ids, attention_mask
+
     def get_output(self, row, tokenizer):
         pass
 
-    def create_item(self, input, output):
+    def get_labels_start(self, item):
+        pass
+
+    def get_item_lengths(self, input_lengths, output_lengths):
         pass
 
     def has_valid_length(self, input, output):
@@ -55,6 +139,9 @@ class ATRDataset(torch.utils.data.Dataset):
     def get_pad_eos_for_generation(self, tokenizer):
         return None, None
 
+    def needs_equal_length_batches(self):
+        return False
+
     def get_decoder_start_token_id(self, tokenizer):
         return None
 
@@ -79,8 +166,11 @@ class EncDecDataset(ATRDataset):
         output = row["output"]
         return tokenizer.encode(output, return_tensors="pt")
 
-    def create_item(self, input, output):
-        return {"input_ids": input, "labels": output, "attention_mask": torch.ones(input.size()).long()}
+    def get_labels_start(self, item):
+        return 0
+
+    def get_item_lengths(self, input_lengths, output_lengths):
+        return np.maximum(input_lengths, output_lengths)
 
     def has_valid_length(self, input, output):
         return input.size(1) <= self.max_length and output.size(1) <= self.max_length
@@ -115,16 +205,27 @@ class DecoderDataset(ATRDataset):
     def get_inference_input(self, row, tokenizer):
         return tokenizer.encode(row["input"], return_tensors="pt")
 
+    def pad_inference_inputs(self, inputs):
+        # Decoder-only models continue the prompt, so prompts would be padded on the left,
+        # although generation batches only hold prompts of equal length
+        max_input_len = max([i.size(1) for i in inputs])
+        input_ids = torch.full((len(inputs), max_input_len), self.pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(inputs), max_input_len), dtype=torch.long)
+        for i, input in enumerate(inputs):
+            input_ids[i, max_input_len - input.size(1) :] = input[0]
+            attention_mask[i, max_input_len - input.size(1) :] = 1
+        return input_ids, attention_mask
+
     def get_output(self, row, tokenizer):
         output = row["output"] + self.eos_token
         return tokenizer.encode(output, return_tensors="pt")
 
-    def create_item(self, input, output):
-        return {
-            "input_ids": input,
-            "labels": torch.cat([torch.zeros(1, input.size(1) - output.size(1)).fill_(-100).long(), output], dim=1),
-            "attention_mask": torch.ones(input.size()).long(),
-        }
+    def get_labels_start(self, item):
+        # The output is the end of the prompt, and the labels of the preceding input tokens are ignored (-100)
+        return len(item["input_ids"]) - len(item["output_ids"])
+
+    def get_item_lengths(self, input_lengths, output_lengths):
+        return input_lengths
 
     def has_valid_length(self, input, output):
         return input.size(1) <= self.max_length
@@ -132,6 +233,10 @@ class DecoderDataset(ATRDataset):
     def get_pad_eos_for_generation(self, tokenizer):
         return self.pad_id, tokenizer.convert_tokens_to_ids(self.eos_token)
 
+    def needs_equal_length_batches(self):
+        # The generation max_length includes the prompt, so a padded prompt would shorten the outputs of shorter prompts
+        return True
+
     def get_new_generated_tokens(self, outputs, input_ids):
         new_tokens_start = input_ids.size(1)
         return outputs[:, new_tokens_start:]
@@ -5,13 +5,18 @@ import inspect
 from encoders.preprocessing.processors import Processors
 import sys
 import logging
-import pickle
+import multiprocessing as mp
+from tqdm import tqdm
 from encoders.preprocessing.commentRemoval import line_is_comment
 from encoders.preprocessing.codeFormatter import add_padding_to_chars
 from pathlib import Path
-from sklearn.feature_extraction.text import TfidfVectorizer
+from encoders.preprocessing.tfidfIndex import TfidfIndex
 from encoders.repositories.changeRepo import ChangeRepository
 from encoders.repositories.callGraphRepo import CallGraphRepository
+from encoders.repositories.stageCacheRepo import StageCacheRepository
+from encoders.repositories.tokenizationRepo import TokenizationRepository
+from encoders.repositories.jsonReader import iter_json_array
+from encoders.repositories.manifestRepo import ManifestRepository
 
 
 class Tokens:
@@ -25,12 +30,27 @@ class Tokens:
     HUNK_END = "[</HUNK>]"
 
 
+def encode_pool_init(_encoder):
+    global encoder
+    encoder = _encoder
+    # Per-project logs of workers are replaced by the aggregated logs of the main process
+    logging.getLogger("MAIN").setLevel(logging.WARNING)
+
+
+def encode_project(task):
+    stage, project_ds = task
+    return getattr(encoder, stage)(project_ds)
+
+
 class AbstractDataEncoder:
     def __init__(self, args):
         self.args = args
         self.logger = logging.getLogger("MAIN")
-        self.change_repo = ChangeRepository(args)
-        self.call_graph_repo = CallGraphRepository(args)
+        self.manifest_repo = ManifestRepository(args)
+        self.change_repo = ChangeRepository(args, self.manifest_repo)
+        self.call_graph_repo = CallGraphRepository(args, self.manifest_repo)
+        # Only the index of the latest commit is kept, as rows of a commit are encoded one after another
+        self.tfidf_index = (None, None)
 
     def create_hunk_document(self, hunk):
         pass
@@ -56,6 +76,7 @@ class AbstractDataEncoder:
         self.tokenizer.add_special_tokens(new_special_tokens)
         self.tokenizer.deprecation_warnings["sequence-length-is-longer-than-the-specified-maximum"] = True
         self.tokenizer.save_pretrained(str(self.args.output_dir / "tokenizer"))
+        self.tokenization_repo = TokenizationRepository(self.args, self.tokenizer)
 
     def shuffle(self, ds):
         return ds.sample(frac=1.0, random_state=self.args.random_seed).reset_index(drop=True)
@@ -95,6 +116,9 @@ class AbstractDataEncoder:
 
         return train_ds, valid_ds, test_ds
 
+    def get_commit_changes(self, row):
+        return self.change_repo.get_commit_changes(row["project"], row["aCommit"])
+
     def get_broken_code(self, row):
         broken_code = ""
         if "sourceChanges" in row["hunk"]:
@@ -107,13 +131,12 @@ class AbstractDataEncoder:
             repaired_code = " ".join([c["line"] for c in row["hunk"]["targetChanges"]])
         return repaired_code
 
-    def get_tfidf_sim(self, target, changes):
-        vectorizer = TfidfVectorizer(tokenizer=lambda t: t, lowercase=False, token_pattern=None)
-        tokenized_docs = [self.tokenizer.encode(target)] + [c["annotated_doc_seq"] for c in changes]
-        vectors = vectorizer.fit_transform(tokenized_docs)
-        dense = vectors.todense()
-        cosine_sim = (dense * dense[0].T).T.tolist()[0]
-        return [cosine_sim[i + 1] for i in range(len(changes))]
+    def get_tfidf_sim(self, row, target, changes):
+        # Rows of the same commit share their changed documents, and hence the index
+        key = (row["project"], row["aCommit"])
+        if self.tfidf_index[0] != key:
+            self.tfidf_index = (key, TfidfIndex([c["annotated_doc_seq"] for c in changes]))
+        return self.tfidf_index[1].get_cosine_sim(self.tokenization_repo.encode([target])[0])
 
     def create_test_context(self, row):
         test_code = row["bSource"]["code"]
@@ -135,7 +158,7 @@ class AbstractDataEncoder:
         if "annotated_doc" not in hunk:
             hunk["annotated_doc"] = self.create_hunk_document(hunk)
         if "annotated_doc_seq" not in hunk:
-            hunk["annotated_doc_seq"] = self.tokenizer.encode(hunk["annotated_doc"])
+            hunk["annotated_doc_seq"] = self.tokenization_repo.encode([hunk["annotated_doc"]])[0]
         change_doc = {"annotated_doc": hunk["annotated_doc"], "annotated_doc_seq": hunk["annotated_doc_seq"]}
         return change_doc
 
@@ -159,11 +182,21 @@ class AbstractDataEncoder:
     def save_oversized_ids(self, ds):
         self.args.dataset_class(ds, self.tokenizer, "all", self.args, save_os_id=True)
 
-    def select_changes(self, row):
+    def tokenize_changed_documents(self, ds):
+        # Tokenizes the documents of all hunks at once, instead of one by one while prioritizing each row's changes
+        commits = ds[["project", "aCommit"]].drop_duplicates()
+        hunks = [h for _, r in commits.iterrows() for c in self.get_commit_changes(r) for h in c["hunks"]]
+        hunks = [h for h in hunks if "annotated_doc_seq" not in h]
+        for hunk in hunks:
+            if "annotated_doc" not in hunk:
+                hunk["annotated_doc"] = self.create_hunk_document(hunk)
+        hunks_seq = self.tokenization_repo.encode([h["annotated_doc"] for h in hunks])
+        for hunk, seq in zip(hunks, hunks_seq):
+            hunk["annotated_doc_seq"] = seq
+
+    def select_changes(self, row, test_context, test_context_e):
         pr_changes_cnt = len(row["prioritized_changes"])
         selected_changes = []
-        test_context = self.create_test_context(row)
-        test_context_e = self.tokenizer.encode(test_context)
         for i in range(pr_changes_cnt):
             row["prioritized_changes"][i]["selected"] = False
             new_selected_changes = selected_changes + [row["prioritized_changes"][i]]
@@ -180,12 +213,10 @@ class AbstractDataEncoder:
 
     def create_inputs_and_outputs(self, ds):
         self.log("Creating inputs and outputs")
-        ds_selected_changes = [self.select_changes(r) for _, r in list(ds.iterrows())]
-
-        all_change_cnt = sum([len(r["prioritized_changes"]) for _, r in ds.iterrows()])
-        included_change_cnt = sum([len(sc[1]) for sc in ds_selected_changes])
-        included_change_p = round(100 * included_change_cnt / all_change_cnt, 1)
-        self.log(f"In total, {included_change_p} % of covered changed documents are included in the input.")
+        rows = [r for _, r in ds.iterrows()]
+        test_contexts = [self.create_test_context(r) for r in rows]
+        test_contexts_e = self.tokenization_repo.encode(test_contexts)
+        ds_selected_changes = [self.select_changes(r, tc, tce) for r, tc, tce in zip(rows, test_contexts, test_contexts_e)]
 
         ds["input"] = [sc[0] for sc in ds_selected_changes]
         ds["output"] = ds.apply(lambda r: self.create_output(r), axis=1)
@@ -194,13 +225,71 @@ class AbstractDataEncoder:
 
         ds["input"] = ds["input"].str.strip()
         ds["output"] = ds["output"].str.strip()
-        self.save_oversized_ids(ds)
+        self.log_encoding_stats(ds)
+        return ds
+
+    def log_encoding_stats(self, ds):
+        all_change_cnt = sum([len(p) for p in ds["prioritized_changes"]])
+        # When no change fits in the input, the first prioritized change is included anyway
+        included_change_cnt = sum([max(1, sum([c["selected"] for c in p])) for p in ds["prioritized_changes"]])
+        included_change_p = round(100 * included_change_cnt / all_change_cnt, 1)
+        self.log(f"In total, {included_change_p} % of covered changed documents are included in the input.")
+
+    def map_projects(self, stage, ds):
+        if self.args.encode_workers <= 1:
+            return getattr(self, stage)(ds)
+
+        # Projects are processed independently and concatenated in their original order, same as the serial path
+        project_ds_list = [g.reset_index(drop=True) for _, g in ds.groupby("project", sort=False)]
+        proc_cnt = min(self.args.encode_workers, len(project_ds_list))
+        self.log(f"Running {stage} on {len(project_ds_list)} projects with {proc_cnt} workers")
+        stage_ds_list = []
+        with mp.Pool(proc_cnt, initializer=encode_pool_init, initargs=(self,)) as pool:
+            tasks = [(stage, project_ds) for project_ds in project_ds_list]
+            for project_ds in tqdm(pool.imap(encode_project, tasks), total=len(tasks), desc=f"Running {stage}"):
+                if len(project_ds) > 0:
+                    stage_ds_list.append(project_ds)
+
+        if len(stage_ds_list) == 0:
+            return ds.iloc[0:0]
+        return pd.concat(stage_ds_list).reset_index(drop=True)
+
+    def encode_data(self):
+        stage_args = {
+            "read_data": ["dataset_dir", "diff_timeout"],
+            "preprocess": ["data_encoder", "model", "model_path"],
+            "create_inputs_and_outputs": ["max_length"],
+        }
+        stage_cache = StageCacheRepository(self.args, self.manifest_repo, stage_args)
+        stages = stage_cache.stages
+        cached_stage = stage_cache.get_deepest_cached_stage()
+        ds = None
+        if cached_stage is not None:
+            ds = stage_cache.load(cached_stage)
+            stages = stages[stages.index(cached_stage) + 1 :]
+
+        for stage in stages:
+            if stage == "read_data":
+                ds = self.read_data()
+                self.log(f"Read {len(ds)} samples from {ds['project'].nunique()} projects")
+            elif stage == "preprocess":
+                ds = self.map_projects(stage, ds)
+                self.log(f"Got {len(ds)} samples after preprocessing")
+                if len(ds) == 0:
+                    self.log(f"Aborting ...")
+                    sys.exit()
+            elif stage == "create_inputs_and_outputs":
+                ds = self.map_projects(stage, ds)
+                if self.args.encode_workers > 1:
+                    self.log_encoding_stats(ds)
+            stage_cache.save(stage, ds)
+
         return ds
 
-    def apply_processor(self, processor, ds):
+    def apply_processor(self, processor, ds, *processor_args):
         before_len = len(ds)
         self.log(f"Applying processor {processor.__name__}")
-        ds = processor(ds, self.args)
+        ds = processor(ds, self.args, *processor_args)
         if before_len != len(ds):
             self.log(f"Removed {before_len - len(ds)} rows by the {processor.__name__} processor")
         return ds
@@ -209,22 +298,32 @@ class AbstractDataEncoder:
         changed_docs = self.get_changed_documents(row)
         return sorted(changed_docs, key=lambda c: self.get_sort_key(c))
 
+    def prioritize_project_changes(self, project_ds):
+        self.tokenize_changed_documents(project_ds)
+        return project_ds.apply(lambda r: self.prioritize_changed_documents(r), axis=1)
+
     def preprocess(self, ds):
+        # The read_data stage may have been loaded from the stage cache
+        self.change_repo.set_required_commits(ds)
         processors = [
-            Processors.remove_empty_changes,
-            Processors.remove_comment_repairs,
-            Processors.remove_no_source_changes,
-            Processors.remove_out_of_range,
-            Processors.remove_oversized_inputs,
-            Processors.format_code,
+            (Processors.remove_empty_changes, self.change_repo),
+            (Processors.remove_comment_repairs,),
+            (Processors.remove_no_source_changes,),
+            (Processors.remove_out_of_range,),
+            (Processors.remove_oversized_inputs, self.manifest_repo),
+            (Processors.format_code,),
         ]
-        for processor in processors:
-            ds = self.apply_processor(processor, ds)
+        for processor, *processor_args in processors:
+            ds = self.apply_processor(processor, ds, *processor_args)
+            if len(ds) == 0:
+                return ds
 
-        self.log("Prioritizing changes")
-        ds["prioritized_changes"] = ds.apply(lambda r: self.prioritize_changed_documents(r), axis=1)
+        # Projects are prioritized one at a time, so only the changes of a few projects are loaded at once
+        self.log("Tokenizing and prioritizing changes")
+        ds["prioritized_changes"] = pd.concat(
+            [self.prioritize_project_changes(project_ds) for _, project_ds in ds.groupby("project", sort=False)]
+        )
         ds = self.apply_processor(Processors.remove_empty_prioritized_changes, ds)
-        ds = ds.drop(columns=["commitChanges"])
         return ds
 
     def remove_duplicate_change_documents(self, change_docs):
@@ -286,11 +385,12 @@ class AbstractDataEncoder:
     def read_data(self):
         ds_path = Path(self.args.dataset_dir)
         ds_list = []
-        ds_paths = list(ds_path.rglob("dataset.json"))
-        for project_ds_path in ds_paths:
-            project_ds = pd.read_json(project_ds_path)
-            project_ds = project_ds.drop(columns=["astActions"])
-            project_ds["project"] = f"{project_ds_path.parent.parent.name}/{project_ds_path.parent.name}"
+        for project in self.manifest_repo.get_projects():
+            project_ds_path = self.manifest_repo.get_project_file(project, "dataset")
+            # astActions are large and unused, so they are dropped while streaming the records
+            records = [{k: v for k, v in r.items() if k != "astActions"} for r in iter_json_array(project_ds_path)]
+            project_ds = pd.DataFrame.from_records(records)
+            project_ds["project"] = project
             if len(project_ds) == 0:
                 continue
             ds_list.append(project_ds)
@@ -298,9 +398,11 @@ class AbstractDataEncoder:
         if len(ds_list) == 0:
             raise Exception(f"No datasets found in {ds_path}")
         ds = pd.concat(ds_list)
-        ds["commitChanges"] = ds.apply(
-            lambda row: self.change_repo.get_commit_changes(row["project"], row["aCommit"]), axis=1
-        )
+        self.change_repo.set_required_commits(ds)
+        # Changes are loaded lazily from the change repository instead of being stored in each row,
+        # but they are visited once here to create their cache and collect the stats
+        for _, row in ds[["project", "aCommit"]].drop_duplicates().iterrows():
+            self.get_commit_changes(row)
         self.change_repo.log_stats(ds)
         return ds
 
@@ -315,20 +417,12 @@ class AbstractDataEncoder:
 
         if train_file.exists() and valid_file.exists() and test_file.exists():
             self.log("Loading train, valid, and test datasets from disk...")
-            train_ds = pickle.load(open(str(train_file), "rb"))
-            valid_ds = pickle.load(open(str(valid_file), "rb"))
-            test_ds = pickle.load(open(str(test_file), "rb"))
+            train_ds = self.args.dataset_class.load(train_file)
+            valid_ds = self.args.dataset_class.load(valid_file)
+            test_ds = self.args.dataset_class.load(test_file)
         else:
-            original_ds = self.read_data()
-            self.log(f"Read {len(original_ds)} samples from {original_ds['project'].nunique()} projects")
-
-            ds = self.preprocess(original_ds)
-            self.log(f"Got {len(ds)} samples after preprocessing")
-            if len(ds) == 0:
-                self.log(f"Aborting ...")
-                sys.exit()
-
-            ds = self.create_inputs_and_outputs(ds)
+            ds = self.encode_data()
+            self.save_oversized_ids(ds)
 
             trivial_ds = ds[~ds["trivial"].isna()].reset_index(drop=True)
             ds = self.apply_processor(Processors.remove_trivial_repairs, ds)
@@ -349,10 +443,10 @@ class AbstractDataEncoder:
             self.log(
                 f"{valid_per} % ({new_ds_s}/{og_ds_s}) samples had less than max_length ({self.args.max_length}) tokens."
             )
-            self.log("Pickling datasets")
-            pickle.dump(train_ds, open(str(train_file), "wb"))
-            pickle.dump(valid_ds, open(str(valid_file), "wb"))
-            pickle.dump(test_ds, open(str(test_file), "wb"))
+            self.log("Saving datasets")
+            train_ds.save(train_file)
+            valid_ds.save(valid_file)
+            test_ds.save(test_file)
 
         ds_len = len(train_ds) + len(valid_ds) + len(test_ds)
         self.log(f"Train: {len(train_ds)} ({round(100 * len(train_ds) / ds_len, 1)} %)")
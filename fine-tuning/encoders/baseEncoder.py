@@ -15,7 +15,7 @@ class BaseDataEncoder(AbstractDataEncoder):
         return annotated_doc
 
     def get_changed_documents(self, row):
-        commit_changes = row["commitChanges"]
+        commit_changes = self.get_commit_changes(row)
         change_docs = []
         for i, change in enumerate(commit_changes):
             for hunk in change["hunks"]:
@@ -27,7 +27,7 @@ class BaseDataEncoder(AbstractDataEncoder):
 
         change_docs = self.remove_duplicate_change_documents(change_docs)
 
-        tfidf_breakage = self.get_tfidf_sim(self.get_broken_code(row), change_docs)
+        tfidf_breakage = self.get_tfidf_sim(row, self.get_broken_code(row), change_docs)
         for i, changed_doc in enumerate(change_docs):
             changed_doc["tfidf_breakage"] = tfidf_breakage[i]
         return change_docs
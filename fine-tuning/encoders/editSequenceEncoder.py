@@ -1,6 +1,7 @@
 import difflib
 import re
 from encoders.preprocessing.codeFormatter import add_padding_to_chars
+from encoders.preprocessing.occurrenceIndex import OccurrenceIndex
 from encoders.wordLevelEncoder import WordLevelDataEncoder, WordLevelTokens
 
 
@@ -33,6 +34,8 @@ REPLACE_NEWS = [
     EditSeqTokens.REPLACE_GROUP_NEW,
 ]
 
+removed_special_tokens_cache = {}
+
 
 class EditSequenceDataEncoder(WordLevelDataEncoder):
     def get_special_tokens_class(self):
@@ -62,41 +65,67 @@ class EditSequenceDataEncoder(WordLevelDataEncoder):
         ds["invalid_eseq"] = False
         ds = super(EditSequenceDataEncoder, self).create_inputs_and_outputs(ds)
         ds["target_change"] = ds.apply(lambda r: self.get_target_change(r), axis=1)
+        return ds
+
+    def log_encoding_stats(self, ds):
+        super(EditSequenceDataEncoder, self).log_encoding_stats(ds)
         invalid_cnt = len(ds[ds["invalid_eseq"]])
         self.log(
             f"Found {invalid_cnt} cases ({round(100 * invalid_cnt / len(ds), 2)} %) where edit sequence could not be generated or was not successfully applied."
         )
-        return ds
+
+    @staticmethod
+    def get_removed_special_tokens(tokenizer):
+        # The removed tokens and a regex finding where any of them starts, built once per tokenizer
+        key = id(tokenizer)
+        if key not in removed_special_tokens_cache:
+            tokens = []
+            for _, v in tokenizer.special_tokens_map.items():
+                if type(v) == list:
+                    tokens.extend(
+                        [t for t in v if t not in REPLACE_NEWS and t not in REPLACE_OLDS and t != EditSeqTokens.REPLACE_END]
+                    )
+                else:
+                    if v not in REPLACE_NEWS and v not in REPLACE_OLDS and v != EditSeqTokens.REPLACE_END:
+                        tokens.append(v)
+            tokens_regex = re.compile("|".join([re.escape(t) for t in tokens])) if len(tokens) > 0 else None
+            removed_special_tokens_cache[key] = (tokenizer, tokens, tokens_regex)
+        return removed_special_tokens_cache[key][1:]
 
     @staticmethod
     def remove_special_tokens(edit_seq, tokenizer):
-        new_edit_seq = ""
-        tokens = []
-        for _, v in tokenizer.special_tokens_map.items():
-            if type(v) == list:
-                tokens.extend(
-                    [t for t in v if t not in REPLACE_NEWS and t not in REPLACE_OLDS and t != EditSeqTokens.REPLACE_END]
-                )
-            else:
-                if v not in REPLACE_NEWS and v not in REPLACE_OLDS and v != EditSeqTokens.REPLACE_END:
-                    tokens.append(v)
+        tokens, tokens_regex = EditSequenceDataEncoder.get_removed_special_tokens(tokenizer)
+        if tokens_regex is None:
+            return edit_seq.strip()
+
+        # Text between tokens is copied at once, and tokens are stripped in the same order as when the sequence was
+        # consumed char by char
+        new_edit_seq = []
+        i = 0
+        while i < len(edit_seq):
+            match = tokens_regex.search(edit_seq, i)
+            if match is None:
+                new_edit_seq.append(edit_seq[i:])
+                break
+            if match.start() > i:
+                new_edit_seq.append(edit_seq[i : match.start()])
+            i = match.start()
 
-        while len(edit_seq) > 0:
             checked = False
             while not checked:
                 checked = True
                 for t in tokens:
-                    if edit_seq.startswith(t):
-                        edit_seq = edit_seq[len(t) :]
-                        if new_edit_seq.endswith(" ") and edit_seq.startswith(" "):
-                            edit_seq = edit_seq[1:]
+                    if edit_seq.startswith(t, i):
+                        i += len(t)
+                        if len(new_edit_seq) > 0 and new_edit_seq[-1].endswith(" ") and edit_seq.startswith(" ", i):
+                            i += 1
                         checked = False
 
-            if len(edit_seq) > 0:
-                new_edit_seq += edit_seq[0]
-                edit_seq = edit_seq[1:]
+            if i < len(edit_seq):
+                new_edit_seq.append(edit_seq[i])
+                i += 1
 
-        return new_edit_seq.strip()
+        return "".join(new_edit_seq).strip()
 
     @staticmethod
     def decode_outputs(row, outputs, tokenizer):
@@ -112,9 +141,14 @@ class EditSequenceDataEncoder(WordLevelDataEncoder):
         if "sourceChanges" in row["hunk"]:
             src = " ".join([c["line"] for c in row["hunk"]["sourceChanges"]])
 
+        # All beams are applied to the same source, and beams may be the same after removing special tokens
+        source_index = OccurrenceIndex(add_padding_to_chars(src))
+        applied_preds = {}
         preds = []
         for p in pred_edit_seqs:
-            applied_pred = apply_edit_sequence(src, p)
+            if p not in applied_preds:
+                applied_preds[p] = apply_edit_sequence(src, p, source_index=source_index)
+            applied_pred = applied_preds[p]
 
             if not applied_pred:
                 preds.append("Invalid Prediction")
@@ -137,6 +171,8 @@ def build_edit_sequence(source, target):
     target = add_padding_to_chars(target)
 
     req_changes = find_token_diffs(source, target)
+    source_index = OccurrenceIndex(source)
+    target_index = OccurrenceIndex(target)
     all_replaces = True
     next_index = -1
     for index, change in [(i, c) for i, c in enumerate(req_changes) if c[0] != "equal"]:
@@ -147,7 +183,7 @@ def build_edit_sequence(source, target):
         replace_found = False
 
         # Only 1 possible replace in the source
-        if source.count(source[source_start:source_end]) == 1:
+        if source_index.count(source[source_start:source_end]) == 1:
             edit_sequence.append(
                 (
                     [
@@ -178,11 +214,11 @@ def build_edit_sequence(source, target):
                     i -= 1
 
                     source_to_replace = (" " if source_start != source_end else "") + source[source_start:source_end]
-                    while source.count(f"{replace}{source_to_replace}") > 1 and i >= 0:
+                    while source_index.count(f"{replace}{source_to_replace}") > 1 and i >= 0:
                         replace = f"{preceding_tokens[i]} {replace}"
                         i -= 1
 
-                    if source.count(f"{replace} {source[source_start:source_end]}") == 1:
+                    if source_index.count(f"{replace} {source[source_start:source_end]}") == 1:
                         edit_sequence.append(
                             (
                                 [
@@ -211,11 +247,11 @@ def build_edit_sequence(source, target):
                     i = 1
 
                     source_to_replace = source[source_start:source_end] + (" " if source_start != source_end else "")
-                    while source.count(f"{source_to_replace}{replace}") > 1 and i <= len(following_tokens) - 1:
+                    while source_index.count(f"{source_to_replace}{replace}") > 1 and i <= len(following_tokens) - 1:
                         replace = f"{replace} {following_tokens[i]}"
                         i += 1
 
-                    if source.count(f"{source[source_start:source_end]} {replace}") == 1:
+                    if source_index.count(f"{source[source_start:source_end]} {replace}") == 1:
                         edit_sequence.append(
                             (
                                 [
@@ -252,7 +288,7 @@ def build_edit_sequence(source, target):
                         + source[source_start:source_end]
                         + (" " if source_start != source_end else "")
                     )
-                    while source.count(f"{replace_before}{source_to_replace}{replace_after}") > 1:
+                    while source_index.count(f"{replace_before}{source_to_replace}{replace_after}") > 1:
                         if i < len(following_tokens):
                             replace_after = f"{replace_after} {following_tokens[i]}"
                         if i < len(preceding_tokens):
@@ -261,7 +297,7 @@ def build_edit_sequence(source, target):
                         if i >= len(following_tokens) and i >= len(preceding_tokens):
                             break
 
-                    if source.count(f"{replace_before} {source[source_start:source_end]} {replace_after}") == 1:
+                    if source_index.count(f"{replace_before} {source[source_start:source_end]} {replace_after}") == 1:
                         edit_sequence.append(
                             (
                                 [
@@ -297,7 +333,7 @@ def build_edit_sequence(source, target):
                     target_end = next_change[4]
                     new_next_index += 2
 
-                    if source.count(replace_source) == 1:
+                    if source_index.count(replace_source) == 1:
                         replace_found = True
 
                 if not replace_found and prev_index >= 1:
@@ -313,7 +349,7 @@ def build_edit_sequence(source, target):
                     target_start = prev_change[3]
                     prev_index -= 2
 
-                    if source.count(replace_source) == 1:
+                    if source_index.count(replace_source) == 1:
                         replace_found = True
 
             if replace_found:
@@ -379,14 +415,14 @@ def build_edit_sequence(source, target):
         token1, s, token2, t, token3 = edit
         if not s in source:
             new_s = add_padding_to_chars(s)
-            if source.count(new_s) == 1:
+            if source_index.count(new_s) == 1:
                 s = new_s
             else:
                 all_replaces = False
 
         if not t in target:
             new_t = add_padding_to_chars(t)
-            if target.count(new_t) == 1:
+            if target_index.count(new_t) == 1:
                 t = new_t
             else:
                 all_replaces = False
@@ -580,22 +616,35 @@ def find_token_diffs(source, target):
     return final_changes
 
 
-def apply_edit_sequence(original_code, edit_seq, replace_pairs=None):
+def apply_edit_sequence(original_code, edit_seq, replace_pairs=None, source_index=None):
     if not replace_pairs:
         replace_pairs = get_replace_pairs(edit_seq)
 
     if not replace_pairs:
         return None
 
-    original_code = add_padding_to_chars(original_code)
+    # The index of the padded original code can be shared by all edit sequences applied to the same code
+    if source_index is None:
+        source_index = OccurrenceIndex(add_padding_to_chars(original_code))
+    original_code = source_index.source
     last_index = len(original_code)
 
     for orig, new in reversed(replace_pairs):
-        if orig is None or new is None or original_code[: last_index + len(orig) - 1].count(orig) != 1:
+        if orig is None or new is None:
+            return None
+
+        # Replaces are applied from the end, so the code before last_index is still the original code. The occurrences
+        # in original_code[: last_index + len(orig) - 1] are the indexed ones before last_index, and the ones crossing it.
+        positions = [p for p in source_index.find_all(orig) if p + len(orig) <= last_index]
+        p = original_code.find(orig, max(0, last_index - len(orig) + 1), last_index + len(orig) - 1)
+        while p != -1:
+            positions.append(p)
+            p = original_code.find(orig, p + 1, last_index + len(orig) - 1)
+        if OccurrenceIndex.count_non_overlapping(positions, len(orig)) != 1:
             return None
 
-        last_index = original_code.index(orig)
-        original_code = original_code.replace(orig, new, 1)
+        last_index = positions[0]
+        original_code = original_code[:last_index] + new + original_code[last_index + len(orig) :]
 
     return original_code
 
@@ -8,6 +8,9 @@ class NoContextDataEncoder(AbstractDataEncoder):
     def get_special_tokens_class(self):
         return NoContextTokens
     
+    def tokenize_changed_documents(self, ds):
+        pass
+
     def prioritize_changed_documents(self, row):
         return [{"annotated_doc": "EMPTY", "annotated_doc_seq": [-1]}]
     
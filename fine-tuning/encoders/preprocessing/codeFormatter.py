@@ -1,5 +1,4 @@
 import re
-import uuid
 
 # Java chars/groups that can be surrounded by ' '
 # In order: ';', '(', ')', '+='/'-='/'*='/'/='/'%=', '->', '++', '+', '--', '-', '**', '*', '//', '/', '%', '{', '}',
@@ -9,39 +8,50 @@ non_word_non_whitespace_non_quote_regex = (
 )
 
 
-def mask_quotes(code):
-    mask_dict = dict()
+string_literal_regex = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+char_literal_regex = re.compile(r"\'.+?\'")
+# The lookahead skips characters that can not start a match, and the group keeps the matches when splitting
+padding_regex = re.compile(r"((?=[;\(\)\{\}\+\-\*\/%<>=!\^&\|:,])(?:" + non_word_non_whitespace_non_quote_regex + "))")
 
-    for s in re.findall(r'"[^"\\]*(?:\\.[^"\\]*)*"', code):
-        id = str(uuid.uuid4()).replace("-", "")
-        code = code.replace(s, id)
-        mask_dict[id] = s
+# Masks are made of private use characters, which are neither word, whitespace, quote nor padded characters
+mask_start = "\ue000"
+mask_end = "\ue001"
 
-    for s in re.findall(r"\'.+?\'", code):
-        id = str(uuid.uuid4()).replace("-", "")
-        code = code.replace(s, id)
-        mask_dict[id] = s
+
+def mask_quotes(code):
+    # Literals are masked in order of appearance, replacing all occurrences of each literal, so that the padded code is
+    # the same as with the previous random masks
+    mask_dict = dict()
+    for quote, literal_regex in [('"', string_literal_regex), ("'", char_literal_regex)]:
+        if quote not in code:
+            continue
+        for s in literal_regex.findall(code):
+            id = f"{mask_start}{len(mask_dict)}{mask_end}"
+            code = code.replace(s, id)
+            mask_dict[id] = s
 
     return code, mask_dict
 
 
 def unmask_quotes(code, mask_dict):
-    for id, val in mask_dict.items():
+    # Reverse order restores string literals masked inside char literals
+    for id, val in reversed(mask_dict.items()):
         code = code.replace(id, val)
 
     return code
 
 
-def space_wrapped_match_group(code, match):
-    return " " + code[match.span()[0] : match.span()[1]] + " "
-
-
 def add_padding_to_chars(code):
-    code, mask_dict = mask_quotes(code)
-    new_code = re.sub(non_word_non_whitespace_non_quote_regex, lambda m: space_wrapped_match_group(code, m), code)
+    # Lines without quotes, i.e. most lines, are padded with a single regex pass. Joining the split code with spaces
+    # is the same as surrounding each match with spaces.
+    has_quotes = '"' in code or "'" in code
+    if has_quotes:
+        code, mask_dict = mask_quotes(code)
+    new_code = " ".join(padding_regex.split(code))
     new_code = new_code.replace("<>", "< >")
-    new_code = " ".join(new_code.split()).strip()
-    new_code = unmask_quotes(new_code, mask_dict)
+    new_code = " ".join(new_code.split())
+    if has_quotes:
+        new_code = unmask_quotes(new_code, mask_dict)
     return new_code
 
 
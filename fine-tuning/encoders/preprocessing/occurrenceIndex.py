@@ -0,0 +1,41 @@
+class OccurrenceIndex:
+    # Positions of the substrings queried from a fixed source. A query containing the previous query, e.g. a replace
+    # grown by one token, only checks the positions of the previous query instead of scanning the whole source.
+    def __init__(self, source):
+        self.source = source
+        self.positions = {}
+        self.last_sub = None
+
+    def find_all(self, sub):
+        if sub in self.positions:
+            positions = self.positions[sub]
+        else:
+            offset = sub.find(self.last_sub) if self.last_sub else -1
+            if offset != -1:
+                positions = [
+                    p - offset
+                    for p in self.positions[self.last_sub]
+                    if p >= offset and self.source.startswith(sub, p - offset)
+                ]
+            else:
+                positions = []
+                p = self.source.find(sub)
+                while p != -1:
+                    positions.append(p)
+                    p = self.source.find(sub, p + 1)
+            self.positions[sub] = positions
+        self.last_sub = sub
+        return positions
+
+    def count(self, sub):
+        return OccurrenceIndex.count_non_overlapping(self.find_all(sub), len(sub))
+
+    @staticmethod
+    def count_non_overlapping(positions, length):
+        # Non-overlapping occurrences among sorted positions, same as str.count
+        count, end = 0, 0
+        for p in positions:
+            if p >= end:
+                count += 1
+                end = p + length
+        return count
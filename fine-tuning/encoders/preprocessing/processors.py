@@ -1,7 +1,6 @@
 from encoders.preprocessing.commentRemoval import remove_hunk_comments, hunk_is_empty
 from encoders.preprocessing.codeFormatter import format_hunk
 from encoders.preprocessing.textDiff import is_whitespace_hunk
-from pathlib import Path
 import pandas as pd
 
 
@@ -19,8 +18,10 @@ class Processors:
         return ds
 
     @staticmethod
-    def remove_empty_changes(ds, args):
-        ds["chn_is_empty"] = ds.apply(lambda r: len(r["commitChanges"]) == 0, axis=1)
+    def remove_empty_changes(ds, args, change_repo):
+        ds["chn_is_empty"] = ds.apply(
+            lambda r: len(change_repo.get_commit_changes(r["project"], r["aCommit"])) == 0, axis=1
+        )
         ds = ds[~ds["chn_is_empty"]].drop(columns=["chn_is_empty"]).reset_index(drop=True)
         return ds
 
@@ -44,9 +45,9 @@ class Processors:
         return ds
 
     @staticmethod
-    def remove_oversized_inputs(ds, args):
-        os_ids_path = Path(args.dataset_dir) / "oversized_ids.csv"
-        if not os_ids_path.exists():
+    def remove_oversized_inputs(ds, args, manifest_repo):
+        os_ids_path = manifest_repo.get_oversized_ids_path()
+        if os_ids_path is None:
             return ds
         os_ids = pd.read_csv(os_ids_path)["id"].values.tolist()
         ds = ds[~ds["ID"].isin(os_ids)].reset_index(drop=True)
@@ -1,48 +1,61 @@
 from diff_match_patch import diff_match_patch
+from functools import lru_cache
 from encoders.preprocessing.utils import get_hunk_lines
 
 
+# Seconds after which a diff returns its best result so far, 0 means no deadline
+diff_timeout = 1.0
+
+
+def set_diff_timeout(timeout):
+    global diff_timeout
+    diff_timeout = timeout
+    get_cached_word_diffs.cache_clear()
+
+
 def diff_wordsToChars(text1, text2):
-    lineArray = []
+    # Maps each word, including its trailing space, to a char so that diff_main diffs sequences of word ids
+    lineArray = [""]
     lineHash = {}
-    lineArray.append("")
 
-    def diff_linesToCharsMunge(text):
+    def diff_linesToCharsMunge(text, maxLines):
+        words = text.split(" ")
+        words = [w + " " for w in words[:-1]] + ([words[-1]] if words[-1] != "" else [])
         chars = []
-        lineStart = 0
-        lineEnd = -1
-        while lineEnd < len(text) - 1:
-            lineEnd = text.find(" ", lineStart)
-            if lineEnd == -1:
-                lineEnd = len(text) - 1
-            line = text[lineStart : lineEnd + 1]
-
-            if line in lineHash:
-                chars.append(chr(lineHash[line]))
-            else:
+        for i, word in enumerate(words):
+            if word not in lineHash:
                 if len(lineArray) == maxLines:
-                    line = text[lineStart:]
-                    lineEnd = len(text)
-                lineArray.append(line)
-                lineHash[line] = len(lineArray) - 1
-                chars.append(chr(len(lineArray) - 1))
-            lineStart = lineEnd + 1
+                    word = "".join(words[i:])
+                    lineArray.append(word)
+                    lineHash[word] = len(lineArray) - 1
+                    chars.append(chr(lineHash[word]))
+                    break
+                lineArray.append(word)
+                lineHash[word] = len(lineArray) - 1
+            chars.append(chr(lineHash[word]))
         return "".join(chars)
 
-    maxLines = 666666
-    chars1 = diff_linesToCharsMunge(text1)
-    maxLines = 1114111
-    chars2 = diff_linesToCharsMunge(text2)
+    chars1 = diff_linesToCharsMunge(text1, 666666)
+    chars2 = diff_linesToCharsMunge(text2, 1114111)
     return (chars1, chars2, lineArray)
 
 
+@lru_cache(maxsize=100000)
+def get_cached_word_diffs(source, target):
+    if source == target:
+        diffs = [(diff_match_patch.DIFF_EQUAL, source)] if len(source) > 0 else []
+    else:
+        dmp = diff_match_patch()
+        dmp.Diff_Timeout = diff_timeout
+        (source, target, linearray) = diff_wordsToChars(source, target)
+        diffs = dmp.diff_main(source, target, False)
+        dmp.diff_charsToLines(diffs, linearray)
+    return tuple((type, text) for type, text in diffs if not text.isspace())
+
+
 def get_word_diffs(source, target):
-    dmp = diff_match_patch()
-    (source, target, linearray) = diff_wordsToChars(source, target)
-    diffs = dmp.diff_main(source, target, False, None)
-    dmp.diff_charsToLines(diffs, linearray)
-    diffs = [d for d in diffs if not d[1].isspace()]
-    return diffs
+    # Diffs are memoized by content, so each hunk is diffed once per run even if several steps need its diffs
+    return list(get_cached_word_diffs(source, target))
 
 
 def get_hunk_diffs(hunk):
@@ -0,0 +1,43 @@
+from collections import Counter
+import numpy as np
+import scipy.sparse as sp
+
+
+class TfidfIndex:
+    # Sparse token counts of a fixed set of tokenized documents. The cosine similarities of a query with the documents
+    # are the same as those of sklearn's TfidfVectorizer (smooth idf, l2 norm) fitted on the query and the documents,
+    # but only the query's contribution to the document frequencies is computed per query.
+    def __init__(self, docs_seq):
+        self.vocab = {}
+        indptr, indices, data = [0], [], []
+        for seq in docs_seq:
+            for token, count in Counter(seq).items():
+                indices.append(self.vocab.setdefault(token, len(self.vocab)))
+                data.append(count)
+            indptr.append(len(indices))
+        shape = (len(docs_seq), len(self.vocab))
+        self.counts = sp.csr_matrix((np.array(data, dtype=np.float64), indices, indptr), shape=shape)
+        self.squared_counts = self.counts.multiply(self.counts).tocsr()
+        self.doc_freq = np.bincount(np.array(indices, dtype=np.int64), minlength=len(self.vocab)).astype(np.float64)
+        self.docs_cnt = len(docs_seq)
+
+    def get_cosine_sim(self, query_seq):
+        query = Counter(query_seq)
+        query_ind = np.array([self.vocab[t] for t in query if t in self.vocab], dtype=np.int64)
+        query_counts = np.array([c for t, c in query.items() if t in self.vocab], dtype=np.float64)
+        oov_counts = np.array([c for t, c in query.items() if t not in self.vocab], dtype=np.float64)
+
+        # The query is a document of the fitted corpus too
+        n_samples = self.docs_cnt + 1
+        doc_freq = self.doc_freq.copy()
+        doc_freq[query_ind] += 1
+        idf = np.log((1 + n_samples) / (1 + doc_freq)) + 1
+        oov_idf = np.log((1 + n_samples) / 2) + 1
+
+        query_weights = np.zeros(len(self.vocab))
+        query_weights[query_ind] = query_counts * idf[query_ind]
+        query_norm = np.sqrt(np.sum(query_weights[query_ind] ** 2) + np.sum((oov_counts * oov_idf) ** 2))
+        docs_norm = np.sqrt(self.squared_counts @ (idf**2))
+        dots = self.counts @ (query_weights * idf)
+        norms = docs_norm * query_norm
+        return np.divide(dots, norms, out=np.zeros(self.docs_cnt), where=norms > 0).tolist()
@@ -1,63 +1,109 @@
+from collections import OrderedDict
+import numpy as np
+import hashlib
 import json
-from pathlib import Path
 import logging
 
 
+class ProjectCallGraphs:
+    # Node depths of all call graphs of a project. Node names and paths are mapped to ids, and each call graph is a
+    # segment of the (memory-mapped) node id and depth arrays, sorted by node id.
+    def __init__(self, cache_dir):
+        self.graphs = json.loads((cache_dir / "graphs.json").read_text())
+        self.node_ids = json.loads((cache_dir / "node_ids.json").read_text())
+        self.ids = np.load(cache_dir / "ids.npy", mmap_mode="r")
+        self.depths = np.load(cache_dir / "depths.npy", mmap_mode="r")
+
+    @staticmethod
+    def create(call_graphs_path, cache_dir):
+        call_graphs = {}
+        for commit, test_call_graphs in json.loads(call_graphs_path.read_text()).items():
+            for test_name, call_graph in test_call_graphs.items():
+                call_graphs[f"{commit}/{test_name}"] = call_graph["nodes"]
+
+        node_ids = {}
+        graphs = {}
+        ids, depths = [], []
+        for key, nodes in call_graphs.items():
+            node_depth = {}
+            max_node_depth = 0
+            for node in nodes:
+                if node["depth"] > max_node_depth:
+                    max_node_depth = node["depth"]
+                for name in [node["name"], node["path"]]:
+                    node_id = node_ids.setdefault(name, len(node_ids))
+                    if node_id not in node_depth:
+                        node_depth[node_id] = node["depth"]
+            start = len(ids)
+            for node_id in sorted(node_depth.keys()):
+                ids.append(node_id)
+                depths.append(node_depth[node_id])
+            graphs[key] = [start, len(ids), max_node_depth]
+
+        tmp_dir = cache_dir.parent / f"{cache_dir.name}.tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        (tmp_dir / "graphs.json").write_text(json.dumps(graphs))
+        (tmp_dir / "node_ids.json").write_text(json.dumps(node_ids))
+        np.save(tmp_dir / "ids.npy", np.array(ids, dtype=np.int32))
+        np.save(tmp_dir / "depths.npy", np.array(depths, dtype=np.int32))
+        tmp_dir.rename(cache_dir)
+
+    def has_call_graph(self, commit, test_name):
+        return f"{commit}/{test_name}" in self.graphs
+
+    def get_depth(self, commit, test_name, node_name):
+        start, end, max_node_depth = self.graphs[f"{commit}/{test_name}"]
+        node_id = self.node_ids.get(node_name)
+        if node_id is None:
+            return max_node_depth
+        i = start + int(np.searchsorted(self.ids[start:end], node_id))
+        if i < end and self.ids[i] == node_id:
+            return int(self.depths[i])
+        return max_node_depth
+
+
 class CallGraphRepository:
-    def __init__(self, args):
-        self.call_graphs_cache = {}
+    def __init__(self, args, manifest_repo, max_cached_projects=4):
+        # Only the call graphs of the most recently used projects are kept in memory
+        self.call_graphs_cache = OrderedDict()
+        self.max_cached_projects = max_cached_projects
         self.args = args
+        self.manifest_repo = manifest_repo
         self.logger = logging.getLogger("MAIN")
 
     def log(self, msg):
         self.logger.info(msg)
 
     def get_call_graph_depth(self, row, hunk, change):
-        call_graph = self.get_call_graph(row["project"], row["bCommit"], row["name"])
-        if len(call_graph) == 0:
+        call_graphs = self.get_project_call_graphs(row["project"])
+        if call_graphs is None or not call_graphs.has_call_graph(row["bCommit"], row["name"]):
             return 0
-        node_depth = call_graph["node_depth"]
-        max_node_depth = call_graph["max_node_depth"]
         if hunk["scope"] == "method":
-            return node_depth.get(hunk["methodName"], max_node_depth)
+            return call_graphs.get_depth(row["bCommit"], row["name"], hunk["methodName"])
         elif hunk["scope"] == "class":
-            return node_depth.get(change["bPath"], max_node_depth)
+            return call_graphs.get_depth(row["bCommit"], row["name"], change["bPath"])
 
-    def get_call_graph(self, project, commit, test_name):
-        key = f"{project}/{commit}/{test_name}"
-        if key in self.call_graphs_cache:
-            return self.call_graphs_cache[key]
-
-        project_call_graphs_cache = self.get_project_call_graphs(project)
-        self.call_graphs_cache.update(project_call_graphs_cache)
+    def get_project_call_graphs(self, project):
+        if project in self.call_graphs_cache:
+            self.call_graphs_cache.move_to_end(project)
+            return self.call_graphs_cache[project]
 
-        if key not in self.call_graphs_cache:
-            self.call_graphs_cache[key] = {}
+        call_graphs = self.load_project_call_graphs(project)
+        self.call_graphs_cache[project] = call_graphs
+        if len(self.call_graphs_cache) > self.max_cached_projects:
+            self.call_graphs_cache.popitem(last=False)
+        return call_graphs
 
-        return self.call_graphs_cache[key]
+    def load_project_call_graphs(self, project):
+        path = self.manifest_repo.get_project_file(project, "call_graphs")
+        if path is None:
+            return None
 
-    def get_project_call_graphs(self, project):
-        ds_path = Path(self.args.dataset_dir)
-        if project not in self.args.dataset_dir:
-            ds_path = ds_path / project
-        path = list(ds_path.rglob(f"call_graphs.json"))
-        call_graphs = {}
-        if len(path) == 1:
-            call_graphs = json.loads(path[0].read_text())
-        project_call_graphs = {}
-        for commit, test_call_graphs in call_graphs.items():
-            for test_name, call_graph in test_call_graphs.items():
-                node_depth = {}
-                max_node_depth = 0
-                for node in call_graph["nodes"]:
-                    if node["depth"] > max_node_depth:
-                        max_node_depth = node["depth"]
-                    if node["name"] not in node_depth:
-                        node_depth[node["name"]] = node["depth"]
-                    if node["path"] not in node_depth:
-                        node_depth[node["path"]] = node["depth"]
-                call_graph["node_depth"] = node_depth
-                call_graph["max_node_depth"] = max_node_depth
-                key = f"{project}/{commit}/{test_name}"
-                project_call_graphs[key] = call_graph
-        return project_call_graphs
+        # The depth lookups are created once per call graphs file and memory-mapped afterwards
+        stat = path.stat()
+        key_data = [str(path), stat.st_size, stat.st_mtime_ns]
+        key = hashlib.sha256(json.dumps(key_data).encode()).hexdigest()[:16]
+        cache_dir = self.args.output_dir / "cache" / "call_graphs" / f"{project.replace('/', '@')}_{key}"
+        if not cache_dir.exists():
+            ProjectCallGraphs.create(path, cache_dir)
+        return ProjectCallGraphs(cache_dir)
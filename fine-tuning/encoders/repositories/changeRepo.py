@@ -1,68 +1,121 @@
 from encoders.preprocessing.commentRemoval import remove_empty_hunks
 from encoders.preprocessing.textDiff import remove_whitespace_hunks
+from encoders.preprocessing import textDiff
 from encoders.preprocessing.codeFormatter import format_sut_changes
 from encoders.preprocessing.utils import get_hunk_location
-from pathlib import Path
+from encoders.repositories.jsonReader import iter_json_array
+from collections import OrderedDict
+import hashlib
+import pickle
 import json
 import logging
 
 
 class ChangeRepository:
-    def __init__(self, args):
-        self.changes_cache = {}
+    def __init__(self, args, manifest_repo, max_cached_projects=4):
+        # Only the changes of the most recently used projects are kept in memory
+        self.changes_cache = OrderedDict()
+        self.max_cached_projects = max_cached_projects
+        # Maps projects to the commits whose changes are needed, None means all commits
+        self.required_commits = {}
         self.stats = {"empty_chn": {}, "hunk_pp": {}, "hunks": 0}
+        self.stats_projects = set()
         self.args = args
+        self.manifest_repo = manifest_repo
         self.logger = logging.getLogger("MAIN")
 
     def log(self, msg):
         self.logger.info(msg)
 
+    def set_required_commits(self, ds):
+        for project, project_ds in ds.groupby("project"):
+            self.required_commits[project] = set(project_ds["aCommit"])
+
     def get_commit_changes(self, project, a_commit):
-        key = f"{project}/{a_commit}"
-        if key in self.changes_cache:
-            return self.changes_cache[key]
+        if project in self.changes_cache:
+            self.changes_cache.move_to_end(project)
+        else:
+            self.changes_cache[project] = self.get_project_changes(project)
+            if len(self.changes_cache) > self.max_cached_projects:
+                self.changes_cache.popitem(last=False)
 
-        project_changes_cache = self.get_project_changes(project)
-        self.changes_cache.update(project_changes_cache)
+        project_changes = self.changes_cache[project]
+        if a_commit not in project_changes:
+            self.stats["empty_chn"][f"{project}/{a_commit}"] = "Not Found"
+            project_changes[a_commit] = []
 
-        if key not in self.changes_cache:
-            self.stats["empty_chn"][key] = "Not Found"
-            self.changes_cache[key] = []
+        return project_changes[a_commit]
 
-        return self.changes_cache[key]
+    def get_changes_path(self, project, change_type):
+        return self.manifest_repo.get_project_file(project, f"{change_type}_changes")
 
-    def read_changes(self, project, change_type):
-        ds_path = Path(self.args.dataset_dir)
-        if project not in self.args.dataset_dir:
-            ds_path = ds_path / project
-        changes_path = list(ds_path.rglob(f"sut_{change_type}_changes.json"))
+    def read_changes(self, changes_path, commits):
         changes = []
-        if len(changes_path) == 1:
-            changes = json.loads(changes_path[0].read_text())
+        if changes_path is not None:
+            # Only the changes of required commits are kept in memory while streaming the file
+            for commit_changes in iter_json_array(changes_path):
+                if commits is None or commit_changes["aCommit"] in commits:
+                    changes.append(commit_changes)
         return changes
 
+    def get_project_cache_file(self, project, changes_paths, commits):
+        key_data = {
+            "project": project,
+            "files": [(str(p), p.stat().st_size, p.stat().st_mtime_ns) for p in changes_paths if p is not None],
+            "commits": sorted(commits) if commits is not None else None,
+            "version": 2,
+            "diff_timeout": textDiff.diff_timeout,
+        }
+        key = hashlib.sha256(json.dumps(key_data).encode()).hexdigest()[:16]
+        return self.args.output_dir / "cache" / "changes" / f"{project.replace('/', '@')}_{key}.pkl"
+
     def get_project_changes(self, project):
-        method_changes = self.read_changes(project, "method")
-        class_changes = self.read_changes(project, "class")
+        # Preprocessed changes of a project are cached on disk and reused by later encodings of the same data
+        commits = self.required_commits.get(project)
+        changes_paths = [self.get_changes_path(project, "method"), self.get_changes_path(project, "class")]
+        cache_file = self.get_project_cache_file(project, changes_paths, commits)
+        if cache_file.exists():
+            with open(str(cache_file), "rb") as f:
+                project_changes, stats = pickle.load(f)
+        else:
+            project_changes, stats = self.create_project_changes(project, *changes_paths, commits)
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(str(cache_file), "wb") as f:
+                pickle.dump((project_changes, stats), f)
+
+        # Evicted projects may be loaded again, but their stats are counted once
+        if project not in self.stats_projects:
+            self.stats_projects.add(project)
+            self.stats["empty_chn"].update(stats["empty_chn"])
+            for k, v in stats["hunk_pp"].items():
+                self.stats["hunk_pp"][k] = self.stats["hunk_pp"].get(k, 0) + v
+            self.stats["hunks"] += stats["hunks"]
+        return project_changes
+
+    def create_project_changes(self, project, method_changes_path, class_changes_path, commits):
+        stats = {"empty_chn": {}, "hunk_pp": {}, "hunks": 0}
+        method_changes = {}
+        for method_commit_changes in self.read_changes(method_changes_path, commits):
+            method_changes.setdefault(method_commit_changes["aCommit"], method_commit_changes)
+        class_changes = self.read_changes(class_changes_path, commits)
         for class_commit_changes in class_changes:
-            for method_commit_changes in method_changes:
-                if method_commit_changes["aCommit"] == class_commit_changes["aCommit"]:
-                    self.label_hunks(class_commit_changes, method_commit_changes)
-                    break
+            method_commit_changes = method_changes.get(class_commit_changes["aCommit"])
+            if method_commit_changes is not None:
+                self.label_hunks(class_commit_changes, method_commit_changes)
         project_changes = {}
         for commit_changes in class_changes:
             commit_changes_wo_t = [c for c in commit_changes["changes"] if not c["is_test_source"]]
-            commit_changes_pp = self.preprocess_changes(commit_changes_wo_t)
+            commit_changes_pp = self.preprocess_changes(commit_changes_wo_t, stats)
             current_key = f"{project}/{commit_changes['aCommit']}"
-            project_changes[current_key] = commit_changes_pp
-            self.stats["hunks"] += self.hunks_count(commit_changes_pp)
+            project_changes[commit_changes["aCommit"]] = commit_changes_pp
+            stats["hunks"] += self.hunks_count(commit_changes_pp)
             if len(commit_changes_pp) == 0:
-                self.stats["empty_chn"][current_key] = self.get_empty_changes_reason(
+                stats["empty_chn"][current_key] = self.get_empty_changes_reason(
                     commit_changes["changes"], commit_changes_wo_t, commit_changes_pp
                 )
-        return project_changes
+        return project_changes, stats
 
-    def preprocess_changes(self, changes):
+    def preprocess_changes(self, changes, stats):
         preprocessors = [
             format_sut_changes,
             remove_whitespace_hunks,
@@ -72,21 +125,22 @@ class ChangeRepository:
             b_len = self.hunks_count(changes)
             changes = preprocess(changes)
             a_len = self.hunks_count(changes)
-            self.stats["hunk_pp"][preprocess.__name__] = self.stats["hunk_pp"].get(preprocess.__name__, 0) + (b_len - a_len)
+            stats["hunk_pp"][preprocess.__name__] = stats["hunk_pp"].get(preprocess.__name__, 0) + (b_len - a_len)
         return changes
 
     def hunks_count(self, changes):
         return sum(len(c["hunks"]) for c in changes)
 
     def label_hunks(self, class_changes, method_changes):
-        for c_change in class_changes["changes"]:
-            m_hunks = {}
-            for m_change in method_changes["changes"]:
-                if c_change["bPath"] != m_change["bPath"] or len(m_change["hunks"]) == 0:
-                    continue
-                for m_hunk in m_change["hunks"]:
-                    m_hunks[get_hunk_location(m_hunk)] = m_change["name"]
+        # Method hunk locations of each file, later method changes of the same file take precedence
+        m_hunks_by_path = {}
+        for m_change in method_changes["changes"]:
+            m_hunks = m_hunks_by_path.setdefault(m_change["bPath"], {})
+            for m_hunk in m_change["hunks"]:
+                m_hunks[get_hunk_location(m_hunk)] = m_change["name"]
 
+        for c_change in class_changes["changes"]:
+            m_hunks = m_hunks_by_path.get(c_change["bPath"], {})
             for c_hunk in c_change["hunks"]:
                 c_hunk["scope"] = "class"
                 c_hunk_loc = get_hunk_location(c_hunk)
@@ -0,0 +1,49 @@
+import json
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+
+
+def iter_json_array(path, chunk_size=1 << 20):
+    # Yields the items of a top-level JSON array one by one, reading the file in chunks
+    # instead of loading and parsing the whole file at once
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = f.read(chunk_size).lstrip(_whitespace)
+        while buffer == "":
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            buffer = chunk.lstrip(_whitespace)
+        if not buffer.startswith("["):
+            raise ValueError(f"Expected a JSON array in {path}")
+        pos = 1
+        eof = False
+        read_size = chunk_size
+        while True:
+            while pos < len(buffer) and buffer[pos] in _whitespace + ",":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                if pos == len(buffer):
+                    raise ValueError("Empty buffer")
+                item, end = _decoder.raw_decode(buffer, pos)
+                # A number cut at the buffer end is decoded partially, so items must be followed by a separator
+                sep_pos = end
+                while sep_pos < len(buffer) and buffer[sep_pos] in _whitespace:
+                    sep_pos += 1
+                if (sep_pos == len(buffer) and not eof) or (sep_pos < len(buffer) and buffer[sep_pos] not in ",]"):
+                    raise ValueError("Item may be truncated")
+            except ValueError:
+                if eof:
+                    raise ValueError(f"Invalid JSON array in {path}")
+                chunk = f.read(read_size)
+                eof = len(chunk) == 0
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                # Items larger than the buffer are decoded again after each read, so reads grow geometrically
+                read_size *= 2
+                continue
+            pos = end
+            read_size = chunk_size
+            yield item
@@ -0,0 +1,114 @@
+from pathlib import Path
+import json
+import logging
+import os
+
+
+class ManifestRepository:
+    # Paths of the benchmark files of each project, collected by a single walk of the dataset directory and persisted
+    # in its manifest.json, so that the repositories and processors do not search the directory tree themselves.
+    project_files = {
+        "dataset.json": "dataset",
+        "sut_method_changes.json": "method_changes",
+        "sut_class_changes.json": "class_changes",
+        "call_graphs.json": "call_graphs",
+    }
+
+    def __init__(self, args):
+        self.args = args
+        self.manifest = None
+        self.logger = logging.getLogger("MAIN")
+
+    def log(self, msg):
+        self.logger.info(msg)
+
+    def get_manifest_path(self):
+        return Path(self.args.dataset_dir) / "manifest.json"
+
+    def get_manifest(self):
+        if self.manifest is not None:
+            return self.manifest
+
+        manifest_path = self.get_manifest_path()
+        if manifest_path.exists():
+            self.manifest = json.loads(manifest_path.read_text())
+            if self.is_valid():
+                return self.manifest
+
+        self.manifest = self.create_manifest()
+        try:
+            manifest_path.write_text(json.dumps(self.manifest, indent=2, sort_keys=True))
+        except OSError as e:
+            self.log(f"Could not save dataset manifest to {manifest_path}: {e}")
+        return self.manifest
+
+    def create_manifest(self):
+        ds_path = Path(self.args.dataset_dir)
+        self.log(f"Creating dataset manifest of {ds_path}")
+        found_files = []
+        oversized_ids = None
+        for dir_path, _, file_names in os.walk(ds_path):
+            for file_name in file_names:
+                path = Path(dir_path) / file_name
+                if file_name in ManifestRepository.project_files:
+                    found_files.append(path)
+                elif file_name == "oversized_ids.csv" and path.parent == ds_path:
+                    oversized_ids = str(path.relative_to(ds_path))
+
+        project_dirs = {p.parent: f"{p.parent.parent.name}/{p.parent.name}" for p in found_files if p.name == "dataset.json"}
+        projects = {project: {} for project in sorted(project_dirs.values())}
+        for path in sorted(found_files):
+            # Each file belongs to the closest project directory containing it
+            for project_dir in [path.parent] + list(path.parent.parents):
+                if project_dir in project_dirs:
+                    file_key = ManifestRepository.project_files[path.name]
+                    projects[project_dirs[project_dir]].setdefault(file_key, str(path.relative_to(ds_path)))
+                    break
+        # New project directories are created either at the top level or inside a directory containing projects,
+        # which changes the modification time of that directory
+        parent_dirs = {d for project_dir in project_dirs for d in project_dir.parents if ds_path in d.parents}
+        dir_mtimes = {str(d.relative_to(ds_path)): d.stat().st_mtime_ns for d in sorted(parent_dirs)}
+        return {
+            "projects": projects,
+            "oversized_ids": oversized_ids,
+            "top_dirs": self.get_top_dirs(),
+            "dir_mtimes": dir_mtimes,
+        }
+
+    def get_top_dirs(self):
+        return sorted(e.name for e in os.scandir(self.args.dataset_dir) if e.is_dir())
+
+    def is_valid(self):
+        # oversized_ids.csv is usually added after mining, so its presence is checked too
+        ds_path = Path(self.args.dataset_dir)
+        if "top_dirs" not in self.manifest or self.manifest["top_dirs"] != self.get_top_dirs():
+            return False
+        for d, mtime in self.manifest["dir_mtimes"].items():
+            if not (ds_path / d).is_dir() or (ds_path / d).stat().st_mtime_ns != mtime:
+                return False
+        has_oversized_ids = (ds_path / "oversized_ids.csv").exists()
+        if has_oversized_ids != (self.manifest["oversized_ids"] is not None):
+            return False
+        return all((ds_path / p).exists() for p in self.get_all_files())
+
+    def get_all_files(self):
+        manifest = self.get_manifest()
+        files = [p for project_files in manifest["projects"].values() for p in project_files.values()]
+        if manifest["oversized_ids"] is not None:
+            files.append(manifest["oversized_ids"])
+        return files
+
+    def get_projects(self):
+        return list(self.get_manifest()["projects"].keys())
+
+    def get_project_file(self, project, file_key):
+        path = self.get_manifest()["projects"].get(project, {}).get(file_key)
+        if path is None:
+            return None
+        return Path(self.args.dataset_dir) / path
+
+    def get_oversized_ids_path(self):
+        path = self.get_manifest()["oversized_ids"]
+        if path is None:
+            return None
+        return Path(self.args.dataset_dir) / path
@@ -0,0 +1,56 @@
+from pathlib import Path
+import pandas as pd
+import hashlib
+import json
+import logging
+
+
+class StageCacheRepository:
+    def __init__(self, args, manifest_repo, stage_args):
+        # stage_args maps each stage (in pipeline order) to the names of the arguments that affect its output
+        self.args = args
+        self.manifest_repo = manifest_repo
+        self.stages = list(stage_args.keys())
+        self.cache_dir = self.args.output_dir / "cache"
+        self.logger = logging.getLogger("MAIN")
+        self.stage_keys = self.get_stage_keys(stage_args)
+
+    def log(self, msg):
+        self.logger.info(msg)
+
+    def get_data_fingerprint(self):
+        ds_path = Path(self.args.dataset_dir)
+        files = sorted([ds_path / f for f in self.manifest_repo.get_all_files()])
+        return [(str(f.relative_to(ds_path)), f.stat().st_size, f.stat().st_mtime_ns) for f in files]
+
+    def get_stage_keys(self, stage_args):
+        # Each key covers the key of the previous stage, so changing a stage invalidates all later stages
+        stage_keys = {}
+        parent_key = self.get_data_fingerprint()
+        for stage, arg_names in stage_args.items():
+            key_data = {
+                "parent": parent_key,
+                "stage": stage,
+                "args": {name: str(getattr(self.args, name)) for name in arg_names},
+            }
+            parent_key = hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+            stage_keys[stage] = parent_key
+        return stage_keys
+
+    def get_cache_file(self, stage):
+        return self.cache_dir / f"{stage}_{self.stage_keys[stage][:16]}.pkl"
+
+    def get_deepest_cached_stage(self):
+        for stage in reversed(self.stages):
+            if self.get_cache_file(stage).exists():
+                return stage
+        return None
+
+    def load(self, stage):
+        cache_file = self.get_cache_file(stage)
+        self.log(f"Loading cached output of stage {stage} from {cache_file}")
+        return pd.read_pickle(cache_file)
+
+    def save(self, stage, ds):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        ds.to_pickle(self.get_cache_file(stage))
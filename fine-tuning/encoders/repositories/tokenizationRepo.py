@@ -0,0 +1,93 @@
+from pathlib import Path
+from array import array
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import sqlite3
+import os
+
+
+class TokenizationRepository:
+    # Content-addressed token ids of texts, persisted in one SQLite file per tokenizer (vocabulary and special tokens),
+    # so that the same texts are tokenized once across encoders and runs sharing the tokenizer.
+    def __init__(self, args, tokenizer, max_cached_texts=100000):
+        self.args = args
+        self.tokenizer = tokenizer
+        # Only the token ids of the most recently used texts are kept in memory, the rest are read from the SQLite file
+        self.tokens_cache = OrderedDict()
+        self.max_cached_texts = max_cached_texts
+        self.connection = None
+        self.connection_pid = None
+        self.logger = logging.getLogger("MAIN")
+        cache_dir = args.token_cache_dir
+        if cache_dir is None:
+            cache_dir = args.output_dir.parent / "token_cache"
+        self.cache_file = Path(cache_dir) / f"{self.get_tokenizer_id()}.sqlite"
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+    def log(self, msg):
+        self.logger.info(msg)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["connection"] = None
+        state["connection_pid"] = None
+        return state
+
+    def get_tokenizer_id(self):
+        tokenizer_data = {
+            "class": type(self.tokenizer).__name__,
+            "vocab": sorted(self.tokenizer.get_vocab().items()),
+            "special_tokens": self.tokenizer.all_special_tokens,
+        }
+        return hashlib.sha256(json.dumps(tokenizer_data).encode()).hexdigest()[:16]
+
+    def get_connection(self):
+        # Connections can not be shared with forked worker processes
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(str(self.cache_file), timeout=600)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS tokens (key BLOB PRIMARY KEY, ids BLOB)")
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    def read_cached_ids(self, keys):
+        connection = self.get_connection()
+        ids_by_key = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            query = f"SELECT key, ids FROM tokens WHERE key IN ({','.join(['?'] * len(chunk))})"
+            for key, ids in connection.execute(query, chunk):
+                ids_by_key[key] = array("i", ids).tolist()
+        return ids_by_key
+
+    def write_cached_ids(self, ids_by_key):
+        connection = self.get_connection()
+        rows = [(key, array("i", ids).tobytes()) for key, ids in ids_by_key.items()]
+        connection.executemany("INSERT OR IGNORE INTO tokens (key, ids) VALUES (?, ?)", rows)
+        connection.commit()
+
+    def update_tokens_cache(self, ids_by_key):
+        for key, ids in ids_by_key.items():
+            self.tokens_cache[key] = ids
+            self.tokens_cache.move_to_end(key)
+        while len(self.tokens_cache) > self.max_cached_texts:
+            self.tokens_cache.popitem(last=False)
+
+    def encode(self, texts):
+        keys = [hashlib.sha256(t.encode()).digest() for t in texts]
+        ids_by_key = {k: self.tokens_cache[k] for k in set(keys) if k in self.tokens_cache}
+        missing_keys = list(set([k for k in keys if k not in ids_by_key]))
+        if len(missing_keys) > 0:
+            ids_by_key.update(self.read_cached_ids(missing_keys))
+
+        new_texts = {k: t for k, t in zip(keys, texts) if k not in ids_by_key}
+        if len(new_texts) > 0:
+            new_keys = list(new_texts.keys())
+            new_ids = self.tokenizer([new_texts[k] for k in new_keys])["input_ids"]
+            new_ids_by_key = dict(zip(new_keys, new_ids))
+            ids_by_key.update(new_ids_by_key)
+            self.write_cached_ids(new_ids_by_key)
+
+        self.update_tokens_cache(ids_by_key)
+        return [list(ids_by_key[k]) for k in keys]
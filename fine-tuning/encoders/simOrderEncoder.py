@@ -4,7 +4,7 @@ from encoders.preprocessing.codeFormatter import add_padding_to_chars
 
 class SimOrderDataEncoder(BaseDataEncoder):
     def get_changed_documents(self, row):
-        commit_changes = row["commitChanges"]
+        commit_changes = self.get_commit_changes(row)
         change_docs = []
         change_repeat = {}
         for i, change in enumerate(commit_changes):
@@ -21,8 +21,8 @@ class SimOrderDataEncoder(BaseDataEncoder):
 
         change_docs = self.remove_duplicate_change_documents(change_docs)
 
-        tfidf_breakage = self.get_tfidf_sim(self.get_broken_code(row), change_docs)
-        tfidf_testsrc = self.get_tfidf_sim(add_padding_to_chars(row["bSource"]["code"]), change_docs)
+        tfidf_breakage = self.get_tfidf_sim(row, self.get_broken_code(row), change_docs)
+        tfidf_testsrc = self.get_tfidf_sim(row, add_padding_to_chars(row["bSource"]["code"]), change_docs)
         for i, changed_doc in enumerate(change_docs):
             changed_doc["tfidf_breakage"] = tfidf_breakage[i]
             changed_doc["tfidf_testsrc"] = tfidf_testsrc[i]
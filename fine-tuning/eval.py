@@ -1,14 +1,14 @@
 from encoders import *
 import pandas as pd
 from datetime import datetime
-from utils import save_stats, get_data_encoder_class
+from utils import save_stats, get_data_encoder_class, create_length_sorted_batches
 from nltk.translate.bleu_score import corpus_bleu
 from CodeBLEU.code_bleu import calc_code_bleu
 from tqdm import tqdm
-import pickle
 import json
+import multiprocessing as mp
 from accelerate import Accelerator
-from accelerate.utils import set_seed
+from accelerate.utils import set_seed, gather_object
 from accelerate.logging import get_logger
 
 
@@ -47,7 +47,8 @@ def test(args):
     bleu_score, code_bleu_score, em = eval(model, "test", args, args.output_dir)
     args.stats["test_results"] = {"bleu": bleu_score, "code_bleu": code_bleu_score, "em": em}
 
-    save_stats(args)
+    if args.accelerator.is_main_process:
+        save_stats(args)
 
 
 def eval(model, split, args, save_dir):
@@ -60,39 +61,93 @@ def eval(model, split, args, save_dir):
     start = datetime.now()
 
     data_encoder_class = get_data_encoder_class(args.data_encoder)
-    tokenizer = args.tokenizer
-    dataset_obj = pickle.load(open(str(args.output_dir / "splits" / f"valid.pkl"), "rb"))
-    pad_id, eos_id = dataset_obj.get_pad_eos_for_generation(tokenizer)
-    decoder_sid = dataset_obj.get_decoder_start_token_id(tokenizer)
+    dataset_obj = args.dataset_class.load(args.output_dir / "splits" / f"valid.pkl")
     model.eval()
 
-    predictions = []
-    for _, row in tqdm(dataset.iterrows(), total=len(dataset), desc="Generating"):
-        input_ids = dataset_obj.get_inference_input(row, tokenizer).to(args.accelerator.device)
-        outputs = model.generate(
-            input_ids,
-            max_length=args.max_length,
-            num_beams=args.beam_size,
-            num_return_sequences=args.beam_size,
-            early_stopping=True,
-            use_cache=True,
-            pad_token_id=pad_id,
-            eos_token_id=eos_id,
-            decoder_start_token_id=decoder_sid,
-        )
-        outputs = dataset_obj.get_new_generated_tokens(outputs, input_ids)
-        preds = data_encoder_class.decode_outputs(row, outputs, tokenizer)
-        predictions.append(preds)
+    predictions = generate_predictions(model, dataset, dataset_obj, data_encoder_class, args)
+    # Predictions are gathered on every process, but only the main process scores and saves them
+    if not args.accelerator.is_main_process:
+        return None, None, None
 
     pred_df = pd.DataFrame(predictions)
-    bleu_score, code_bleu_score, em = compute_scores(pred_df)
+    bleu_score, code_bleu_score, em = compute_scores(pred_df, args.code_bleu_workers)
     logger.info(f"* BLEU: {bleu_score} ; CodeBLEU: {code_bleu_score} ; EM: {em} ; Eval took: {datetime.now() - start}")
     save_dir.mkdir(parents=True, exist_ok=True)
     pred_df.to_json(save_dir / f"{split}_predictions.json", orient="records", indent=2)
     return bleu_score, code_bleu_score, em
 
 
-def compute_scores(pred_df):
+def decode_pool_init(_data_encoder_class, _tokenizer):
+    global decode_encoder_class, decode_tokenizer
+    decode_encoder_class = _data_encoder_class
+    decode_tokenizer = _tokenizer
+
+
+def decode_row(task):
+    i, row, outputs = task
+    return i, decode_encoder_class.decode_outputs(row, outputs, decode_tokenizer)
+
+
+def generate_predictions(model, dataset, dataset_obj, data_encoder_class, args):
+    tokenizer = args.tokenizer
+    accelerator = args.accelerator
+    model = accelerator.unwrap_model(model)
+    pad_id, eos_id = dataset_obj.get_pad_eos_for_generation(tokenizer)
+    decoder_sid = dataset_obj.get_decoder_start_token_id(tokenizer)
+
+    rows = [row for _, row in dataset.iterrows()]
+    inputs = [dataset_obj.get_inference_input(row, tokenizer) for row in rows]
+    batches = create_length_sorted_batches(
+        [i.size(1) for i in inputs], args.gen_batch_size, dataset_obj.needs_equal_length_batches()
+    )
+    # Each process generates a strided share of the length-sorted batches, so all shards get similar workloads
+    batches = batches[accelerator.process_index :: accelerator.num_processes]
+
+    pool = None
+    if args.decode_workers > 1:
+        # Generated beams are decoded by worker processes while the next batches are generated
+        pool = mp.Pool(args.decode_workers, initializer=decode_pool_init, initargs=(data_encoder_class, tokenizer))
+    pending_predictions = []
+
+    shard_predictions = []
+    shard_size = sum([len(b) for b in batches])
+    with tqdm(total=shard_size, desc="Generating", disable=not accelerator.is_local_main_process) as pbar:
+        for batch in batches:
+            input_ids, attention_mask = dataset_obj.pad_inference_inputs([inputs[i] for i in batch])
+            input_ids = input_ids.to(accelerator.device)
+            attention_mask = attention_mask.to(accelerator.device)
+            outputs = model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                max_length=args.max_length,
+                num_beams=args.beam_size,
+                num_return_sequences=args.beam_size,
+                early_stopping=True,
+                use_cache=True,
+                pad_token_id=pad_id,
+                eos_token_id=eos_id,
+                decoder_start_token_id=decoder_sid,
+            )
+            outputs = dataset_obj.get_new_generated_tokens(outputs, input_ids)
+            # Each row has beam_size consecutive sequences in the generated outputs
+            for j, i in enumerate(batch):
+                row_outputs = outputs[j * args.beam_size : (j + 1) * args.beam_size]
+                if pool is None:
+                    shard_predictions.append((i, data_encoder_class.decode_outputs(rows[i], row_outputs, tokenizer)))
+                else:
+                    pending_predictions.append(pool.apply_async(decode_row, ((i, rows[i], row_outputs.cpu()),)))
+            pbar.update(len(batch))
+
+    if pool is not None:
+        shard_predictions.extend([p.get() for p in pending_predictions])
+        pool.close()
+        pool.join()
+
+    all_predictions = sorted(gather_object(shard_predictions), key=lambda p: p[0])
+    return [pred for _, pred in all_predictions]
+
+
+def compute_scores(pred_df, workers=1):
     eval_size = pred_df["ID"].nunique()
     em_size = 0
     best_preds = []
@@ -110,11 +165,11 @@ def compute_scores(pred_df):
         targets.append(target)
 
     em = round(em_size / eval_size * 100, 2)
-    bleu_score, code_bleu_score = compute_bleu_scores(targets, best_preds)
+    bleu_score, code_bleu_score = compute_bleu_scores(targets, best_preds, workers=workers)
     return bleu_score, code_bleu_score, em
 
 
-def compute_bleu_scores(targets, preds, sf=None):
+def compute_bleu_scores(targets, preds, sf=None, workers=1):
     if len(targets) != len(preds):
         raise Exception(f"Targets and preds size mismatch: {len(targets)} != {len(preds)}")
     format_score = lambda score: round(100 * score, 2)
@@ -124,6 +179,6 @@ def compute_bleu_scores(targets, preds, sf=None):
     tokenized_hypotheses = [simple_tokenize(pred) for pred in preds]
     bleu_score = corpus_bleu(tokenized_references, tokenized_hypotheses, smoothing_function=sf)
 
-    code_bleu_score = calc_code_bleu([targets], preds)
+    code_bleu_score = calc_code_bleu([targets], preds, workers=workers)
 
     return format_score(bleu_score), format_score(code_bleu_score)
@@ -0,0 +1,72 @@
+from encoders.preprocessing.codeFormatter import add_padding_to_chars, non_word_non_whitespace_non_quote_regex
+from encoders.repositories.manifestRepo import ManifestRepository
+from encoders.repositories.jsonReader import iter_json_array
+import argparse
+import time
+import uuid
+import re
+
+
+# The formatter before masks became deterministic, kept as the reference of the benchmark
+def legacy_add_padding_to_chars(code):
+    mask_dict = dict()
+    for s in re.findall(r'"[^"\\]*(?:\\.[^"\\]*)*"', code):
+        id = str(uuid.uuid4()).replace("-", "")
+        code = code.replace(s, id)
+        mask_dict[id] = s
+    for s in re.findall(r"\'.+?\'", code):
+        id = str(uuid.uuid4()).replace("-", "")
+        code = code.replace(s, id)
+        mask_dict[id] = s
+
+    new_code = re.sub(non_word_non_whitespace_non_quote_regex, lambda m: " " + m.group() + " ", code)
+    new_code = new_code.replace("<>", "< >")
+    new_code = " ".join(new_code.split()).strip()
+    for id, val in mask_dict.items():
+        new_code = new_code.replace(id, val)
+    return new_code
+
+
+def read_hunk_lines(args):
+    manifest_repo = ManifestRepository(args)
+    lines = []
+    for project in manifest_repo.get_projects():
+        for file_key in ["dataset", "class_changes"]:
+            path = manifest_repo.get_project_file(project, file_key)
+            if path is None:
+                continue
+            for record in iter_json_array(path):
+                hunks = [record["hunk"]] if "hunk" in record else [h for c in record["changes"] for h in c["hunks"]]
+                for hunk in hunks:
+                    for change in hunk.get("sourceChanges", []) + hunk.get("targetChanges", []):
+                        lines.append(change["line"])
+                if len(lines) >= args.max_lines:
+                    return lines[: args.max_lines]
+    return lines
+
+
+def benchmark(format_fn, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [format_fn(l) for l in lines]
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset_dir", required=True, type=str)
+    parser.add_argument("-ml", "--max_lines", required=False, type=int, default=200000)
+    parser.add_argument("-r", "--repeat", required=False, type=int, default=3)
+    args = parser.parse_args()
+
+    lines = read_hunk_lines(args)
+    print(f"Read {len(lines)} hunk lines from {args.dataset_dir}")
+    legacy_time, legacy_outputs = benchmark(legacy_add_padding_to_chars, lines, args.repeat)
+    new_time, new_outputs = benchmark(add_padding_to_chars, lines, args.repeat)
+    mismatches = sum(1 for l, n in zip(legacy_outputs, new_outputs) if l != n)
+    print(f"Legacy formatter: {round(legacy_time, 3)}s")
+    print(f"Current formatter: {round(new_time, 3)}s ({round(legacy_time / new_time, 2)}x speedup)")
+    print(f"Different outputs: {mismatches}")
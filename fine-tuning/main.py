@@ -16,6 +16,7 @@ from train import train
 from eval import test
 from dataset import EncDecDataset, PLBARTDataset, CodeGenDataset
 from utils import get_data_encoder_class
+from encoders.preprocessing.textDiff import set_diff_timeout
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(name)s |   %(message)s",
@@ -38,6 +39,9 @@ def main():
     encode_parser.add_argument("-ts", "--train_size", default=0.8, type=float)
     encode_parser.add_argument("-tf", "--train_fraction", default=1.0, type=float)
     encode_parser.add_argument("-mpr", "--mask_projects", default=None, type=lambda s: s.split(","))
+    encode_parser.add_argument("-ew", "--encode_workers", default=1, type=int)
+    encode_parser.add_argument("-tcd", "--token_cache_dir", default=None, type=str)
+    encode_parser.add_argument("-dt", "--diff_timeout", default=1.0, type=float)
 
     finetune_parser.set_defaults(func=train)
     add_common_arguments(finetune_parser)
@@ -47,11 +51,17 @@ def main():
     finetune_parser.add_argument("-lr", "--learning_rate", required=True, type=float)
     finetune_parser.add_argument("-es", "--early_stop", default=10, type=int)
     finetune_parser.add_argument("-ga", "--gradient_accumulation", default=1, type=int)
+    finetune_parser.add_argument("-lb", "--length_bucketing", dest="length_bucketing", action="store_true")
+    finetune_parser.add_argument("-mtb", "--max_tokens_per_batch", default=None, type=int)
+    finetune_parser.add_argument("-mbs", "--max_batch_samples", default=None, type=int)
 
     test_parser.set_defaults(func=test)
     add_common_arguments(test_parser)
     test_parser.add_argument("-de", "--data_encoder", required=True, type=str)
     test_parser.add_argument("-bs", "--beam_size", default=5, type=int)
+    test_parser.add_argument("-gbs", "--gen_batch_size", default=1, type=int)
+    test_parser.add_argument("-dw", "--decode_workers", default=1, type=int)
+    test_parser.add_argument("-cbw", "--code_bleu_workers", default=1, type=int)
     test_parser.add_argument("-mpr", "--mask_projects", default=None, type=lambda s: s.split(","))
 
     args = parser.parse_args()
@@ -87,6 +97,7 @@ def add_common_arguments(sub_parser):
 def encode(args):
     logger = logging.getLogger("MAIN")
     logger.info(f"Arguments:\n {args}")
+    set_diff_timeout(args.diff_timeout)
     data_encoder_class = get_data_encoder_class(args.data_encoder)
     data_encoder = data_encoder_class(args)
     data_encoder.create_datasets()
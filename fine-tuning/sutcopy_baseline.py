@@ -4,6 +4,7 @@ from encoders.preprocessing.textDiff import get_hunk_diffs
 from diff_match_patch import diff_match_patch as dmp
 from tqdm import tqdm
 from encoders.repositories.changeRepo import ChangeRepository
+from encoders.repositories.manifestRepo import ManifestRepository
 from encoders.abstractEncoder import AbstractDataEncoder
 import argparse
 import pandas as pd
@@ -19,7 +20,7 @@ if __name__ == "__main__":
     args.output_dir.mkdir(parents=True, exist_ok=True)
 
     ade = AbstractDataEncoder(None)
-    change_repo = ChangeRepository(args=args)
+    change_repo = ChangeRepository(args, ManifestRepository(args))
 
     with open(str(args.output_dir / "splits/test.json"), "r") as f:
         test_set = json.load(f)
@@ -6,7 +6,7 @@ import torch
 from datetime import datetime, timedelta
 from encoders import *
 from utils import create_loader, save_stats
-import pickle
+import math
 from accelerate import Accelerator
 from accelerate.utils import set_seed
 from accelerate.logging import get_logger
@@ -14,7 +14,10 @@ from accelerate.logging import get_logger
 
 def train(args):
     logger = get_logger("MAIN", log_level=args.log_level)
-    args.accelerator = Accelerator(gradient_accumulation_steps=args.gradient_accumulation)
+    args.accelerator = Accelerator(
+        gradient_accumulation_steps=args.gradient_accumulation,
+        even_batches=args.max_tokens_per_batch is None,
+    )
     logger.info(f"Arguments:\n {args}")
     set_seed(args.random_seed)
     logger.info(
@@ -23,18 +26,18 @@ def train(args):
         main_process_only=False,
     )
 
-    args.train_dataset = pickle.load(open(str(args.output_dir / "splits" / f"train.pkl"), "rb"))
-    args.valid_dataset = pickle.load(open(str(args.output_dir / "splits" / f"valid.pkl"), "rb"))
+    args.train_dataset = args.dataset_class.load(args.output_dir / "splits" / f"train.pkl")
+    args.valid_dataset = args.dataset_class.load(args.output_dir / "splits" / f"valid.pkl")
     args.tokenizer = args.model_tokenizer_class.from_pretrained(args.output_dir / "tokenizer")
 
     train_loader = create_loader(args.train_dataset, args)
-    train_steps = int(args.epochs * len(train_loader))
+    train_steps, scheduler_steps = get_train_steps(train_loader, args)
 
     model = args.model_class.from_pretrained(args.model_path, trust_remote_code=True)
     model.resize_token_embeddings(len(args.tokenizer))
 
     optimizer = AdamW(model.parameters(), lr=args.learning_rate)
-    scheduler = get_cosine_schedule_with_warmup(optimizer, num_warmup_steps=0, num_training_steps=train_steps)
+    scheduler = get_cosine_schedule_with_warmup(optimizer, num_warmup_steps=0, num_training_steps=scheduler_steps)
 
     model, optimizer, train_loader, scheduler = args.accelerator.prepare(model, optimizer, train_loader, scheduler)
 
@@ -51,7 +54,9 @@ def train(args):
     args.stats["valid_set_size"] = len(args.valid_dataset)
     args.stats["training_stats"] = {"epochs": []}
     step_start = datetime.now()
-    tbs = args.accelerator.state.num_processes * args.num_nodes * args.batch_size
+    # Batches packed by the token budget vary in size, so the trained samples are counted from the actual batches
+    process_cnt = args.accelerator.state.num_processes * args.num_nodes
+    trained_samples = 0
     for epoch in range(1, args.epochs + 1):
         model.train()
         epoch_start = datetime.now()
@@ -73,11 +78,12 @@ def train(args):
                 optimizer.zero_grad()
 
             global_step += 1
+            trained_samples += process_cnt * data["input_ids"].size(0)
             if global_step % 60 == 0:
                 step_time = datetime.now() - step_start
-                train_per_s = step_time.total_seconds() / (tbs * global_step)
+                train_per_s = step_time.total_seconds() / trained_samples
                 logger.debug(
-                    f"Global step {global_step} ; Elapsed {step_time} ; Samples {tbs*global_step} ; Train/sample {round(train_per_s, 3)} s"
+                    f"Global step {global_step} ; Elapsed {step_time} ; Samples {trained_samples} ; Train/sample {round(train_per_s, 3)} s"
                 )
 
         # End of epoch
@@ -158,6 +164,23 @@ def validate(args, model, epoch, epoch_stats):
     epoch_stats["valid_loss"] = avg_loss
 
 
+def get_train_steps(train_loader, args):
+    if args.max_tokens_per_batch is not None:
+        # Token-budget batching gives a different number of batches in each epoch
+        epoch_batches = [len(train_loader.batch_sampler.create_batches(e)) for e in range(args.epochs)]
+    else:
+        epoch_batches = [len(train_loader)] * args.epochs
+    train_steps = sum(epoch_batches)
+
+    # The prepared scheduler only steps on optimizer steps (end of each gradient accumulation cycle or epoch),
+    # and then it steps once per process
+    num_processes = args.accelerator.num_processes
+    scheduler_steps = sum(
+        [math.ceil(math.ceil(b / num_processes) / args.gradient_accumulation) * num_processes for b in epoch_batches]
+    )
+    return train_steps, scheduler_steps
+
+
 def gather_loss(loss, args):
     loss_gathered = args.accelerator.gather_for_metrics(loss).detach()
     if len(loss_gathered.shape) == 0:
@@ -5,38 +5,132 @@ import sys
 from encoders import *
 
 
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    # Each pool of bucket_size_multiplier batches is sorted by length before batching, so batches hold
+    # similar-sized samples while the batch order stays random. Iterations are seeded to be reproducible.
+    # If max_tokens is given, the token budget alone decides the batches: samples are packed as long as the padded
+    # size (samples * longest sample) stays within max_tokens, optionally capped at max_batch_samples samples, and
+    # pools hold about bucket_size_multiplier token budgets. The number of batches then changes between epochs.
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        seed,
+        max_tokens=None,
+        max_batch_samples=None,
+        num_processes=1,
+        bucket_size_multiplier=50,
+    ):
+        self.lengths = lengths
+        self.max_batch_samples = max_batch_samples
+        # Accelerate expects no batch_size for batch samplers yielding variable-sized batches
+        self.batch_size = batch_size if max_tokens is None else None
+        self.seed = seed
+        self.max_tokens = max_tokens
+        self.num_processes = num_processes
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.bucket_tokens = None if max_tokens is None else max_tokens * bucket_size_multiplier
+        self.epoch = 0
+        self.epoch_batches = None
+
+    def create_buckets(self, shuffled_ind):
+        if self.max_tokens is None:
+            return [shuffled_ind[i : i + self.bucket_size] for i in range(0, len(shuffled_ind), self.bucket_size)]
+
+        buckets = []
+        bucket, bucket_tokens = [], 0
+        for j in shuffled_ind:
+            bucket.append(j)
+            bucket_tokens += self.lengths[j]
+            if bucket_tokens >= self.bucket_tokens:
+                buckets.append(bucket)
+                bucket, bucket_tokens = [], 0
+        if len(bucket) > 0:
+            buckets.append(bucket)
+        return buckets
+
+    def split_bucket(self, bucket):
+        if self.max_tokens is None:
+            return [bucket[j : j + self.batch_size] for j in range(0, len(bucket), self.batch_size)]
+
+        batches = []
+        batch, batch_max_len = [], 0
+        for j in bucket:
+            new_max_len = max(batch_max_len, self.lengths[j])
+            is_full = self.max_batch_samples is not None and len(batch) == self.max_batch_samples
+            if len(batch) > 0 and (is_full or (len(batch) + 1) * new_max_len > self.max_tokens):
+                batches.append(batch)
+                batch, new_max_len = [], self.lengths[j]
+            batch.append(j)
+            batch_max_len = new_max_len
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def create_batches(self, epoch):
+        if self.epoch_batches is not None and self.epoch_batches[0] == epoch:
+            return self.epoch_batches[1]
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        shuffled_ind = torch.randperm(len(self.lengths), generator=generator).tolist()
+        batches = []
+        for bucket in self.create_buckets(shuffled_ind):
+            batches.extend(self.split_bucket(sorted(bucket, key=lambda j: self.lengths[j])))
+        batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        if self.max_tokens is not None and len(batches) % self.num_processes != 0:
+            # Repeat the first batches so that all processes run the same number of steps
+            batches += batches[: self.num_processes - len(batches) % self.num_processes]
+
+        self.epoch_batches = (epoch, batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.create_batches(self.epoch)
+        self.epoch += 1
+        for batch in batches:
+            yield batch
+
+    def __len__(self):
+        return len(self.create_batches(self.epoch))
+
+
 def create_loader(dataset, args, valid_mode=False):
-    def custom_collate(batch):
-        batch_data = {"input_ids": [], "labels": [], "attention_mask": []}
-        max_input_len = max([b["input_ids"].size(1) for b in batch])
-        max_output_len = max([b["labels"].size(1) for b in batch])
-        for b in batch:
-            batch_data["input_ids"].append(
-                torch.cat(
-                    [b["input_ids"], torch.zeros(1, max_input_len - b["input_ids"].size(1)).fill_(dataset.pad_id).long()],
-                    dim=1,
-                )
-            )
-            batch_data["labels"].append(
-                torch.cat([b["labels"], torch.zeros(1, max_output_len - b["labels"].size(1)).fill_(-100).long()], dim=1)
-            )
-            batch_data["attention_mask"].append(
-                torch.cat([b["attention_mask"], torch.zeros(1, max_input_len - b["attention_mask"].size(1))], dim=1)
-            )
-        batch_data["input_ids"] = torch.cat(batch_data["input_ids"], dim=0)
-        batch_data["labels"] = torch.cat(batch_data["labels"], dim=0)
-        batch_data["attention_mask"] = torch.cat(batch_data["attention_mask"], dim=0)
-        return batch_data
+    if (args.length_bucketing or args.max_tokens_per_batch is not None) and not valid_mode:
+        batch_sampler = LengthBucketBatchSampler(
+            dataset.get_lengths(),
+            args.batch_size,
+            args.random_seed,
+            max_tokens=args.max_tokens_per_batch,
+            max_batch_samples=args.max_batch_samples,
+            num_processes=args.accelerator.num_processes,
+        )
+        return DataLoader(dataset=dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate)
 
     loader = DataLoader(
         dataset=dataset,
         batch_size=args.batch_size,
-        collate_fn=custom_collate,
+        collate_fn=dataset.collate,
         shuffle=(not valid_mode),
     )
     return loader
 
 
+def create_length_sorted_batches(lengths, batch_size, equal_lengths=False):
+    # Groups indices of similar lengths into the same batch to keep padding small
+    sorted_ind = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    if not equal_lengths:
+        return [sorted_ind[i : i + batch_size] for i in range(0, len(sorted_ind), batch_size)]
+
+    # With equal_lengths, indices of different lengths are never batched together
+    batches = []
+    for i in sorted_ind:
+        if len(batches) == 0 or len(batches[-1]) == batch_size or lengths[batches[-1][0]] != lengths[i]:
+            batches.append([])
+        batches[-1].append(i)
+    return batches
+
+
 def save_stats(args):
     with open(str(args.output_dir / "stats.json"), "w") as f:
         f.write(json.dumps(args.stats, indent=2, sort_keys=False))
@@ -8,6 +8,7 @@ from utils import (
     save_file,
     is_test_class,
     get_java_diffs,
+    get_java_changes,
     hunk_to_string,
     get_short_hash,
 )
@@ -16,21 +17,39 @@ import shutil
 import maven_parser as mvnp
 from coverage_repository import MethodChangesRepository
 import multiprocessing as mp
+import contextlib
+import os
 from trivial_detector import TrivialDetector
 from error_stats import ErrorStats
 
 
 def pool_init(_lock):
     global lock
-    lock = _lock
+    lock = _lock if _lock is not None else contextlib.nullcontext()
+    ghapi.reset_repo_cache()
 
 
 class DataCollector:
-    def __init__(self, repo_name, output_path):
+    def __init__(self, repo_name, output_path, incremental=False, since_commit=None, worktree_lock=True):
         self.repo_name = repo_name
         self.output_path = Path(output_path)
+        self.incremental = incremental
+        self.worktree_lock = worktree_lock
+        # Commits reachable from since_commit have been mined before and are excluded from Phase #1
+        self.since_commit = since_commit
 
     def collect_test_repairs(self):
+        repaired_tests = self.mine_test_repairs()
+        if len(repaired_tests) > 0 and not (self.incremental and (self.output_path / "dataset.json").exists()):
+            self.make_dataset(repaired_tests)
+
+        if self.incremental:
+            print("Mining new commits incrementally")
+            self.collect_new_test_repairs()
+
+        ErrorStats.report()
+
+    def mine_test_repairs(self):
         print("Phase #1: Identifying changed tests and extracting their changes")
         self.identify_changed_test_classes()
         jparser.compare_test_classes(self.output_path)
@@ -40,7 +59,7 @@ class DataCollector:
         repaired_tests = self.detect_repaired_tests()
         if len(repaired_tests) == 0:
             print("No repaired tests found")
-            return
+            return []
         print()
 
         print("Phase #3: Identifying and extracting covered changes")
@@ -51,27 +70,22 @@ class DataCollector:
         ghapi.cleanup_worktrees(self.repo_name)
         print()
 
-        self.make_dataset(repaired_tests)
-
-        ErrorStats.report()
-
-    def get_commit_changed_test_classes(self, commit_sha):
-        commit = ghapi.get_commit(commit_sha, self.repo_name)
-        if len(commit.parents) == 0:
-            return []
+        return repaired_tests
 
+    def get_commit_changed_test_classes(self, commit):
         commit_changed_test_classes = []
-        diffs = get_java_diffs(commit, ["R", "M"])
-        for diff in diffs:
-            before, after = ghapi.get_file_versions(diff, commit, self.repo_name)
+        for change in commit["changes"]:
+            if change["b_blob"] == change["a_blob"]:
+                continue
+            before, after = ghapi.get_file_versions(change, self.repo_name)
             if is_test_class(before) and before != after:
-                b_commit = ghapi.get_short_commit(commit.parents[0], self.repo_name)
-                a_commit = ghapi.get_short_commit(commit, self.repo_name)
+                b_commit = ghapi.get_short_commit(commit["parents"][0], self.repo_name)
+                a_commit = ghapi.get_short_commit(commit["sha"], self.repo_name)
                 commit_changed_test_classes.append(
-                    {"b_path": diff.b_path, "a_path": diff.a_path, "b_commit": b_commit, "a_commit": a_commit}
+                    {"b_path": change["b_path"], "a_path": change["a_path"], "b_commit": b_commit, "a_commit": a_commit}
                 )
-                b_copy_path = self.output_path / "codeMining" / "testClasses" / b_commit / diff.b_path
-                a_copy_path = self.output_path / "codeMining" / "testClasses" / a_commit / diff.a_path
+                b_copy_path = self.output_path / "codeMining" / "testClasses" / b_commit / change["b_path"]
+                a_copy_path = self.output_path / "codeMining" / "testClasses" / a_commit / change["a_path"]
                 try:
                     save_file(before, b_copy_path)
                     save_file(after, a_copy_path)
@@ -79,37 +93,65 @@ class DataCollector:
                     lock.acquire()
                     b_commit_path = ghapi.copy_commit_code(self.repo_name, b_commit, "0")
                     b_copy_path.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copyfile(str(b_commit_path / diff.b_path), str(b_copy_path))
+                    shutil.copyfile(str(b_commit_path / change["b_path"]), str(b_copy_path))
                     ghapi.remove_commit_code(self.repo_name, b_commit_path)
 
                     a_commit_path = ghapi.copy_commit_code(self.repo_name, a_commit, "0")
                     a_copy_path.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copyfile(str(a_commit_path / diff.a_path), str(a_copy_path))
+                    shutil.copyfile(str(a_commit_path / change["a_path"]), str(a_copy_path))
                     ghapi.remove_commit_code(self.repo_name, a_commit_path)
                     lock.release()
 
         return commit_changed_test_classes
 
+    def iter_candidate_commits(self, head_commit):
+        # Only commits modifying or renaming Java files can change a test class, so other commits are never diffed
+        self.commits_cnt = 0
+        rev = head_commit if self.since_commit is None else f"{self.since_commit}..{head_commit}"
+        for commit in ghapi.iter_commit_changes(self.repo_name, ["*.java"], rev):
+            commit["changes"] = get_java_changes(commit["changes"], ["R", "M"])
+            if len(commit["parents"]) > 0 and len(commit["changes"]) > 0:
+                self.commits_cnt += 1
+                yield commit
+
     def identify_changed_test_classes(self):
         changed_test_classes_path = self.output_path / "codeMining" / "changed_test_classes.csv"
         if changed_test_classes_path.exists():
             print("Changed tests classes already exists, skipping ...")
             return
-        commits = ghapi.get_all_commits(self.repo_name)
-        commits_sha = [c.hexsha for c in commits]
 
+        head_commit = ghapi.get_commit_sha("origin/HEAD", self.repo_name)
         changed_test_classes = []
         with mp.Pool(initializer=pool_init, initargs=(mp.Lock(),)) as pool:
             for commit_changed_test_classes in tqdm(
-                pool.imap_unordered(self.get_commit_changed_test_classes, commits_sha),
-                total=len(commits_sha),
+                pool.imap_unordered(self.get_commit_changed_test_classes, self.iter_candidate_commits(head_commit)),
                 ascii=True,
                 desc="Identifying changed test classes",
             ):
                 changed_test_classes.extend(commit_changed_test_classes)
+        print(f"Found {self.commits_cnt} commits changing Java files")
 
         changed_test_classes = pd.DataFrame(changed_test_classes)
         changed_test_classes.to_csv(changed_test_classes_path, index=False)
+        self.get_mined_commit_path().write_text(head_commit)
+
+    def get_mined_commit_path(self):
+        return self.output_path / "codeMining" / "mined_commit.txt"
+
+    def get_mined_commit(self):
+        mined_commit_path = self.get_mined_commit_path()
+        if mined_commit_path.exists():
+            return mined_commit_path.read_text().strip()
+
+        # Outputs mined before the commit was recorded continue from the changed test class commit that has all the
+        # others as ancestors. The commits after it in the mined history changed no test class.
+        changed_test_classes = pd.read_csv(self.output_path / "codeMining" / "changed_test_classes.csv", dtype=str)
+        mined_commit = None
+        if "a_commit" in changed_test_classes and not changed_test_classes.empty:
+            mined_commit = ghapi.get_descendant_commit(changed_test_classes["a_commit"].tolist(), self.repo_name)
+        if mined_commit is None:
+            print(f"The last mined commit of {self.output_path} is unknown, mine the repository without --incremental")
+        return mined_commit
 
     def run_original_test(self, project_path, change):
         test_b_path = Path(change["bPath"])
@@ -130,10 +172,8 @@ class DataCollector:
         changes = changes.reset_index(drop=True)
         b_commit = changes.iloc[0]["bCommit"]
 
-        lock.acquire()
-        a_commit_path = ghapi.copy_commit_code(self.repo_name, a_commit, "0")
-        b_commit_path = ghapi.copy_commit_code(self.repo_name, b_commit, a_commit)
-        lock.release()
+        a_commit_path = self.checkout_worker_worktree("a", a_commit)
+        b_commit_path = self.checkout_worker_worktree("b", b_commit)
 
         for _, change in changes.iterrows():
             test_name = change["name"]
@@ -204,13 +244,17 @@ class DataCollector:
                 }
             )
 
-        lock.acquire()
-        ghapi.remove_commit_code(self.repo_name, a_commit_path)
-        ghapi.remove_commit_code(self.repo_name, b_commit_path)
-        lock.release()
-
         return changed_tests_verdicts, repaired_tests, tests_coverage
 
+    def checkout_worker_worktree(self, name, commit):
+        # Each worker keeps its own worktrees and switches them between the commit groups it executes, instead of
+        # creating and removing full checkouts per group
+        worktree_path = ghapi.get_worktrees_path() / f"worker-{os.getpid()}-{name}"
+        if worktree_path.exists():
+            return ghapi.switch_worktree(worktree_path, commit)
+        with lock:
+            return ghapi.add_worktree(self.repo_name, worktree_path, commit)
+
     def print_execution_stats(self, changed_tests_verdicts, repaired_tests, changed_tests_cnt):
         print(f"Executed {changed_tests_cnt} test cases!")
         print(f"Found {len(repaired_tests)} repaired tests")
@@ -265,7 +309,8 @@ class DataCollector:
 
         proc_cnt = round(mp.cpu_count() / 3) if mp.cpu_count() > 2 else 1
         proc_cnt = min(proc_cnt, len(change_groups))
-        with mp.Pool(proc_cnt, initializer=pool_init, initargs=(mp.Lock(),)) as pool:
+        worktree_lock = mp.Lock() if self.worktree_lock else None
+        with mp.Pool(proc_cnt, initializer=pool_init, initargs=(worktree_lock,)) as pool:
             for verdicts, repaired, test_coverage in tqdm(
                 pool.imap_unordered(self.run_changed_tests, change_groups),
                 total=len(change_groups),
@@ -338,29 +383,123 @@ class DataCollector:
                 file_changes["is_test_source"] = is_test_source(file_changes["bPath"], file_changes["aPath"])
         sut_method_changes_path.write_text(json.dumps(sut_method_changes, indent=2, sort_keys=False))
 
-    def make_dataset(self, repaired_tests):
+    def collect_new_test_repairs(self):
+        mined_commit = self.get_mined_commit()
+        if mined_commit is None:
+            return
+        # An increment is only removed after its merge, so a leftover one with the same commit is already merged
+        increment_path = self.output_path / "increment"
+        increment_mined_commit_path = increment_path / "codeMining" / "mined_commit.txt"
+        if increment_mined_commit_path.exists() and increment_mined_commit_path.read_text().strip() == mined_commit:
+            shutil.rmtree(str(increment_path))
+        ghapi.fetch_commits(self.repo_name)
+        if ghapi.get_commit_sha("origin/HEAD", self.repo_name) == mined_commit:
+            print(f"No new commits since {mined_commit}")
+            return
+
+        # The new commits are mined by the same phases in a separate directory, which shares the clone of the repo
+        increment_clone_path = increment_path / "codeMining" / "clone"
+        if not increment_clone_path.exists():
+            increment_clone_path.parent.mkdir(parents=True, exist_ok=True)
+            increment_clone_path.symlink_to(ghapi.get_clone_dir().absolute(), target_is_directory=True)
+        collector = DataCollector(
+            self.repo_name, increment_path, since_commit=mined_commit, worktree_lock=self.worktree_lock
+        )
+        repaired_tests = collector.mine_test_repairs()
+
+        # The ids of the new repairs continue after the existing ones. They are recorded before merging, so that a
+        # rerun after an interrupted merge assigns the same ids.
+        merge_path = increment_path / "merge.json"
+        if not merge_path.exists():
+            repaired_tests_path = self.output_path / "codeMining" / "repaired_tests.json"
+            id_offset = len(json.loads(repaired_tests_path.read_text())) if repaired_tests_path.exists() else 0
+            write_file(merge_path, json.dumps({"id_offset": id_offset}))
+        id_offset = json.loads(merge_path.read_text())["id_offset"]
+
+        self.merge_increment(increment_path)
+        if len(repaired_tests) > 0:
+            self.label_changed_test_sources()
+            dataset_path = self.output_path / "dataset.json"
+            dataset_repairs = json.loads(dataset_path.read_text()) if dataset_path.exists() else []
+            self.make_dataset(repaired_tests, dataset_repairs, id_offset)
+
+        write_file(self.get_mined_commit_path(), collector.get_mined_commit_path().read_text())
+        shutil.rmtree(str(increment_path))
+
+    def merge_increment(self, increment_path):
+        # Records already present are skipped, so merging the same increment again leaves the outputs unchanged
+        print("Merging new commits data ...")
+        commit_key = lambda r: (r["bCommit"], r["aCommit"])
+        test_key = lambda r: (r["bCommit"], r["aCommit"], r["name"], r["bPath"], r["aPath"])
+        for file, key_fn in [
+            ("codeMining/changed_tests.json", lambda r: (r["bCommit"], r["aCommit"], get_repair_key(r))),
+            ("codeMining/repaired_tests.json", lambda r: (r["bCommit"], r["aCommit"], get_repair_key(r))),
+            ("codeMining/changed_sut_classes.json", commit_key),
+            ("codeMining/sut_class_changes.json", commit_key),
+            ("codeMining/sut_method_changes.json", commit_key),
+            ("testExecution/changed_tests_verdicts.json", test_key),
+        ]:
+            merge_json_files(increment_path / file, self.output_path / file, get_merge_records_fn(key_fn), [])
+
+        def merge_commit_dicts(old, new):
+            for commit, values in new.items():
+                old.setdefault(commit, {})
+                old[commit].update(values)
+            return old
+
+        for file in ["codeMining/call_graphs.json", "codeMining/test_elements.json", "testExecution/coverage.json"]:
+            merge_json_files(increment_path / file, self.output_path / file, merge_commit_dicts, {})
+        merge_json_files(
+            increment_path / "codeMining" / "rename_refactorings.json",
+            self.output_path / "codeMining" / "rename_refactorings.json",
+            lambda old, new: {**old, **new},
+            {},
+        )
+
+        changed_test_classes_path = self.output_path / "codeMining" / "changed_test_classes.csv"
+        changed_test_classes = [
+            pd.read_csv(path, dtype=str)
+            for path in [changed_test_classes_path, increment_path / "codeMining" / "changed_test_classes.csv"]
+            if path.exists()
+        ]
+        changed_test_classes = [df for df in changed_test_classes if not df.empty]
+        if len(changed_test_classes) > 0:
+            changed_test_classes = pd.concat(changed_test_classes).drop_duplicates(
+                subset=["b_commit", "a_commit", "b_path", "a_path"]
+            )
+            write_file(changed_test_classes_path, changed_test_classes.to_csv(index=False))
+
+        for directory in [
+            "codeMining/testClasses",
+            "codeMining/brokenPatches",
+            "testExecution/originalExeLogs",
+            "testExecution/brokenExeLogs",
+            "testExecution/repairedExeLogs",
+        ]:
+            if (increment_path / directory).exists():
+                shutil.copytree(str(increment_path / directory), str(self.output_path / directory), dirs_exist_ok=True)
+
+    def make_dataset(self, repaired_tests, dataset_repairs=None, id_offset=0):
+        # New repairs are merged into the repairs of an existing dataset, with the same deduplication
         method_change_repo = MethodChangesRepository(self.output_path)
         trivial_detector = TrivialDetector(self.output_path)
         dup_cnt = 0
         dataset = {}
-        for i, repair in tqdm(enumerate(repaired_tests), total=len(repaired_tests), ascii=True, desc="Creating dataset"):
+        for repair in dataset_repairs or []:
+            dataset[get_repair_key(repair)] = repair
+        commit_times = ghapi.get_commit_times([r["aCommit"] for r in repaired_tests], self.repo_name)
+        for i, repair in tqdm(
+            enumerate(repaired_tests, id_offset), total=len(repaired_tests), ascii=True, desc="Creating dataset"
+        ):
             _repair = copy.deepcopy(repair)
 
-            _repair["aCommitTime"] = ghapi.get_commit_time(_repair["aCommit"], self.repo_name)
+            _repair["aCommitTime"] = commit_times[_repair["aCommit"]]
             _repair["ID"] = f"{self.repo_name}:{i}"
             _repair["trivial"] = trivial_detector.detect_trivial_repair(
                 _repair["name"], _repair["aCommit"], _repair["bCommit"]
             )
             _repair["hunk"] = method_change_repo.get_test_hunk(_repair)
-            repair_key = (
-                _repair["name"]
-                + "||"
-                + _repair["bPath"]
-                + "||"
-                + _repair["bSource"]["code"]
-                + "||"
-                + hunk_to_string(_repair["hunk"])
-            )
+            repair_key = get_repair_key(_repair)
             if repair_key in dataset:
                 dup_cnt += 1
             if repair_key not in dataset or dataset[repair_key]["aCommitTime"] < _repair["aCommitTime"]:
@@ -371,5 +510,41 @@ class DataCollector:
 
         dataset_l = list(dataset.values())
         dataset_l.sort(key=lambda r: r["aCommitTime"], reverse=True)
-        (self.output_path / "dataset.json").write_text(json.dumps(dataset_l, indent=2, sort_keys=False))
+        write_file(self.output_path / "dataset.json", json.dumps(dataset_l, indent=2, sort_keys=False))
         print(f"Done! Saved {len(dataset)} test repairs.")
+
+
+def get_repair_key(repair):
+    return (
+        repair["name"]
+        + "||"
+        + repair["bPath"]
+        + "||"
+        + repair["bSource"]["code"]
+        + "||"
+        + hunk_to_string(repair["hunk"])
+    )
+
+
+def get_merge_records_fn(key_fn):
+    def merge_records(old, new):
+        old_keys = set(key_fn(r) for r in old)
+        return old + [r for r in new if key_fn(r) not in old_keys]
+
+    return merge_records
+
+
+def merge_json_files(src_path, dst_path, merge_fn, empty_value):
+    if not src_path.exists():
+        return
+    dst_value = json.loads(dst_path.read_text()) if dst_path.exists() else empty_value
+    merged_value = merge_fn(dst_value, json.loads(src_path.read_text()))
+    write_file(dst_path, json.dumps(merged_value, indent=2, sort_keys=False))
+
+
+def write_file(path, content):
+    # Written to a temporary file first, so an interrupted write never leaves a truncated file behind
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.parent / f"{path.name}.tmp"
+    tmp_path.write_text(content)
+    os.replace(str(tmp_path), str(path))
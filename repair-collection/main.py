@@ -7,7 +7,9 @@ from data_collector import DataCollector
 
 
 def collect_test_repairs(args):
-    collector = DataCollector(args.repository, args.output_path)
+    collector = DataCollector(
+        args.repository, args.output_path, incremental=args.incremental, worktree_lock=not args.no_worktree_lock
+    )
     collector.collect_test_repairs()
 
 
@@ -47,6 +49,20 @@ def main():
         required=False,
         default=None,
     )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        help="Mine only the commits added since the last run and merge their repairs into the existing dataset",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "-nwl",
+        "--no-worktree-lock",
+        help="Let the test execution workers create their worktrees without waiting for each other",
+        action="store_true",
+        required=False,
+    )
 
     args = parser.parse_args()
     Config.set("repo", args.repository)
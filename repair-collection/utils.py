@@ -30,6 +30,16 @@ def get_java_diffs(commit, change_types=None):
     return diffs
 
 
+def get_java_changes(changes, change_types=None):
+    if change_types is not None:
+        changes = [c for c in changes if c["change_type"] in change_types]
+    java_regex = r"^.*\.java$"
+    changes = [
+        c for c in changes if bool(re.search(java_regex, c["b_path"])) and bool(re.search(java_regex, c["a_path"]))
+    ]
+    return changes
+
+
 def hunk_to_string(hunk):
     output = ""
     for l in hunk.get("sourceChanges", []):